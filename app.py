@@ -1,49 +1,287 @@
+import logging
 import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+import stat
+import time
+from functools import partial
+
+from flask import (Flask, Blueprint, Response, render_template, request, flash,
+                   redirect, session, g, abort, jsonify, get_flashed_messages,
+                   stream_with_context, current_app)
+from flask.logging import default_handler
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError
 
+from caching import static_assets, not_modified, cache_headers
+from changes import changes
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from fragments import fragment_cache
+from metrics import metrics, TimedQueuePool
+from models import db, connect_db, User, Message, Likes
+from pagination import keyset_page, InvalidCursor
+from passwords import PasswordHasherBusy
+from querystats import query_stats, logger as query_logger
+from search import (search_users, username_index, search_messages,
+                    search_key, SEARCH_KEY_TYPES, directory_users,
+                    username_key, USERNAME_KEY_TYPES)
+from timelines import (fan_out_message, remove_message, backfill_follow,
+                       prune_follow, check_fanout_drops, timeline_messages)
+from usercache import user_snapshots
 
 CURR_USER_KEY = "curr_user"
+BUSY_MESSAGE = "We're handling a lot of sign-ins right now. Please try again."
+
+PROFILES = ('production', 'development')
+
+# tries at inserting a new message before giving up on an id clash
+POST_ATTEMPTS = 3
+
+# what a profile page shows of its user
+PROFILE_COLUMNS = ['username', 'image_url', 'header_image_url', 'bio',
+                   'location', 'message_count', 'following_count',
+                   'follower_count', 'like_count']
+
+logger = logging.getLogger('warbler')
+
+bp = Blueprint('warbler', __name__)
+
+
+def configure(app):
+    """Settings shared by every profile, mostly from the environment."""
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': TimedQueuePool}
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+    app.config['TIMELINE_LENGTH'] = int(os.environ.get('TIMELINE_LENGTH', 800))
+    app.config['TIMELINE_TRIM_EVERY'] = int(
+        os.environ.get('TIMELINE_TRIM_EVERY', 50))
+    app.config['TIMELINE_FANOUT_THRESHOLD'] = int(
+        os.environ.get('TIMELINE_FANOUT_THRESHOLD', 10000))
+    app.config['MESSAGES_PER_PAGE'] = int(
+        os.environ.get('MESSAGES_PER_PAGE', 20))
+    app.config['MAX_BULK_FOLLOWS'] = 100
+    app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 60))
+    app.config['USER_SEARCH_LIMIT'] = int(
+        os.environ.get('USER_SEARCH_LIMIT', 50))
+    app.config['AUTOCOMPLETE_LIMIT'] = 10
+    app.config['USERNAME_INDEX_TTL'] = int(
+        os.environ.get('USERNAME_INDEX_TTL', 300))
+    app.config['MESSAGE_SEARCH_HALF_LIFE'] = int(
+        os.environ.get('MESSAGE_SEARCH_HALF_LIFE', 7 * 24 * 3600))
+    app.config['MESSAGE_SEARCH_CANDIDATES'] = int(
+        os.environ.get('MESSAGE_SEARCH_CANDIDATES', 1000))
+
+    # Logged-in users are cached between requests (see usercache.py).
+    app.config['CURRENT_USER_CACHE_SIZE'] = int(
+        os.environ.get('CURRENT_USER_CACHE_SIZE', 1024))
+    app.config['CURRENT_USER_CACHE_TTL'] = float(
+        os.environ.get('CURRENT_USER_CACHE_TTL', 5))
+
+    # Password hashing runs in a small process pool (see passwords.py).
+    app.config['BCRYPT_LOG_ROUNDS'] = int(
+        os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    app.config['PASSWORD_HASH_WORKERS'] = int(
+        os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    app.config['PASSWORD_HASH_QUEUE'] = int(
+        os.environ.get('PASSWORD_HASH_QUEUE', 8))
+
+    # Per-request SQL statistics, logged as JSON lines (see querystats.py).
+    app.config['QUERY_STATS_SLOWEST'] = 3
+    app.config['QUERY_STATS_REPEAT_THRESHOLD'] = int(
+        os.environ.get('QUERY_STATS_REPEAT_THRESHOLD', 5))
+    app.config['QUERY_STATS_SUMMARY_INTERVAL'] = int(
+        os.environ.get('QUERY_STATS_SUMMARY_INTERVAL', 300))
+
+    # Prometheus metrics at /metrics; workers that share a server should
+    # share a METRICS_DIR (see metrics.py).
+    app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+
+    # Compiled templates, shared by the workers of a production server.
+    # Unset, Jinja keeps them in a private per-user directory of its own.
+    app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR')
+
+    # Committed changes reach other workers by NOTIFY on this channel
+    # (see changes.py).
+    app.config['CHANGES_CHANNEL'] = os.environ.get('CHANGES_CHANNEL',
+                                                   'warbler_changes')
+
+    # Rendered message items and user cards (see fragments.py).
+    app.config['FRAGMENT_CACHE_BYTES'] = int(
+        os.environ.get('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024))
+
+    # Fingerprinted static files are cached this long (see caching.py).
+    app.config['STATIC_MAX_AGE'] = int(
+        os.environ.get('STATIC_MAX_AGE', 365 * 24 * 3600))
+
+
+def private_directory(path):
+    """Create `path` if needed and make sure only this user can write it.
+
+    Bytecode read back from a directory someone else controls would run
+    their code, so anything but a directory of ours, mode 0700, is refused.
+    """
+
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise ValueError(f"{path} is not a directory owned by this user")
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        raise ValueError(f"{path} must have mode 0700, not "
+                         f"{stat.S_IMODE(info.st_mode):04o}")
+
+    return path
+
+
+def precompile_templates(app):
+    """Compile every template now rather than on the first request for it.
+
+    The bytecode goes to TEMPLATE_CACHE_DIR (or Jinja's private directory
+    for this user), so workers started later (and the next deploy of the
+    same templates) load it instead of parsing.
+    """
+
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    app.jinja_env.bytecode_cache = (
+        FileSystemBytecodeCache(private_directory(directory)) if directory
+        else FileSystemBytecodeCache())
+
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+def create_app(profile=None):
+    """Build the Warbler app.
 
-app = Flask(__name__)
+    `profile` is 'production' or 'development'; by default it comes from
+    FLASK_ENV, which (as in Flask) means production when unset.
+    Development turns on debugging and the debug toolbar; production
+    leaves both out and precompiles the templates. Neither connects to the
+    database: the engine is created by the first request that needs it.
+    """
+
+    started = time.perf_counter()
+
+    profile = profile or os.environ.get('FLASK_ENV', 'production')
+    if profile not in PROFILES:
+        raise ValueError(f"unknown profile {profile!r}")
+
+    app = Flask(__name__)
+    app.env = profile
+    app.debug = profile == 'development'
+    configure(app)
+
+    if not logger.handlers:
+        logger.addHandler(default_handler)
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+    query_logger.setLevel(os.environ.get('QUERY_LOG_LEVEL', 'INFO'))
+
+    if profile == 'development':
+        from flask_debugtoolbar import DebugToolbarExtension
+
+        app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+        DebugToolbarExtension(app)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+    connect_db(app)
+    query_stats.init_app(app)
+    metrics.init_app(app)
+    static_assets.init_app(app)
+    fragment_cache.init_app(app)
+    changes.init_app(app)
+    app.register_blueprint(bp)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+    user_snapshots.maxsize = app.config['CURRENT_USER_CACHE_SIZE']
+    user_snapshots.ttl = app.config['CURRENT_USER_CACHE_TTL']
 
-connect_db(app)
+    if profile == 'production':
+        precompile_templates(app)
+
+    elapsed = time.perf_counter() - started
+    metrics.set('warbler_startup_seconds', elapsed)
+    logger.info("started %s app in %.1f ms", profile, elapsed * 1000)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a cached read-only snapshot; routes that change the user
+    should use current_user() instead.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = user_snapshots.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+def current_user():
+    """The logged-in user as a full ORM object, loaded on first use.
+
+    Only for routes that change the user: committing the change drops its
+    cached snapshot.
+    """
+
+    if 'orm_user' not in g:
+        g.orm_user = User.query.get_or_404(g.user.id)
+
+    return g.orm_user
+
+
+@bp.app_template_global()
+def viewer_following_ids():
+    """Ids the logged-in user follows; fetched at most once per request."""
+
+    if 'following_ids' not in g:
+        g.following_ids = g.user.following_ids() if g.user else set()
+
+    return g.following_ids
+
+
+def viewer_follow_states(users):
+    """Which of `users` the logged-in user follows, in one query."""
+
+    if not g.user:
+        return set()
+
+    return g.user.follow_states(user.id for user in users)[0]
+
+
+def stream_template(template_name, **context):
+    """Render a template to the client as it is generated.
+
+    The response is sent before the template runs, so the session is
+    already saved by then: flashed messages are taken here, up front, and
+    the template reads them back from the request.
+    """
+
+    get_flashed_messages()
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+
+    return Response(stream_with_context(template.generate(context)))
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    user_snapshots.forget(user.id)
 
 
 def do_logout():
@@ -53,7 +291,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -81,6 +319,10 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except PasswordHasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -89,15 +331,19 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except PasswordHasherBusy:
+            flash(BUSY_MESSAGE, 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
             do_login(user)
@@ -109,7 +355,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -122,41 +368,82 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+def timeline_page(user_id):
+    """Page of `user_id`'s timeline picked by the `before`/`after` cursors."""
+
+    try:
+        return keyset_page(partial(timeline_messages, user_id),
+                           per_page=current_app.config['MESSAGES_PER_PAGE'],
+                           before=request.args.get('before'),
+                           after=request.args.get('after'))
+    except InvalidCursor:
+        abort(400)
+
+
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Without a query this is the whole directory, USERS_PER_PAGE users at
+    a time by username cursor. Can take a 'q' param in querystring to
+    search by that username; the best USER_SEARCH_LIMIT matches are shown.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        try:
+            page = keyset_page(directory_users,
+                               current_app.config['USERS_PER_PAGE'],
+                               before=request.args.get('before'),
+                               after=request.args.get('after'),
+                               key=username_key,
+                               types=USERNAME_KEY_TYPES)
+        except InvalidCursor:
+            abort(400)
+        users = page.items
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = None
+        users = search_users(search)
 
-    return render_template('users/index.html', users=users)
+    return stream_template('users/index.html', users=users, page=page,
+                           following_ids=viewer_follow_states(users))
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/autocomplete')
+def users_autocomplete():
+    """JSON list of users whose username starts with the 'q' param."""
+
+    matches = username_index.complete(request.args.get('q', ''))
+
+    return jsonify([{'id': user_id, 'username': username}
+                    for user_id, username in matches])
+
+
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter((Message.user_id == user_id) | (Message.user_id.in_([u.id for u in user.following])))
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    # the profile shows this user's timeline: their own messages plus
+    # those of the people they follow
+    page = timeline_page(user_id)
 
+    cached = not_modified(
+        [getattr(user, column) for column in PROFILE_COLUMNS],
+        user.id in viewer_following_ids(),
+        [(msg.id, msg.user.username, msg.user.image_url)
+         for msg in page.items],
+        page.newer, page.older)
+    if cached is not None:
+        return cached
 
-@app.route('/users/<int:user_id>/following')
+    return render_template('users/show.html', user=user,
+                           messages=page.items, page=page)
+
+
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -165,10 +452,11 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return render_template('users/following.html', user=user,
+                           following_ids=viewer_follow_states(user.following))
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -177,10 +465,11 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    return render_template('users/followers.html', user=user,
+                           following_ids=viewer_follow_states(user.followers))
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -189,13 +478,38 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+
+    if current_user().follow([followed_user.id]):
+        backfill_follow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow', methods=['POST'])
+def add_follows():
+    """Follow several users at once (e.g. suggestions during onboarding).
+
+    Takes the ids to follow as repeated 'user_id' form fields.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user_ids = request.form.getlist('user_id', type=int)
+
+    if len(user_ids) > current_app.config['MAX_BULK_FOLLOWS']:
+        abort(400)
+
+    for followed_id in current_user().follow(user_ids):
+        backfill_follow(g.user.id, followed_id)
+    db.session.commit()
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -203,14 +517,16 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+
+    if current_user().unfollow(followed_user.id):
+        prune_follow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -224,11 +540,11 @@ def profile():
         if form.validate_on_submit():
 
             password = form.password.data
-            username = form.username.data,
+            username = form.username.data
 
-            if User.authenticate(username, password):
+            if User.authenticate(g.user.username, password):
                 
-                g.user.edit_user(
+                current_user().edit_user(
                 username = username,
                 email = form.email.data,
                 image_url = form.image_url.data,
@@ -250,7 +566,7 @@ def profile():
 
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -260,12 +576,17 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user = current_user()
+    unfollowed = user.remove_from_counters()
+    db.session.delete(user)
+    db.session.flush()
+    check_fanout_drops(unfollowed)
     db.session.commit()
 
+
     return redirect("/signup")
 
-@app.route('/users/<user_id>/likes', methods=["GET"])
+@bp.route('/users/<user_id>/likes', methods=["GET"])
 def liked_warbles(user_id):
     """List of liked warbles"""
 
@@ -274,10 +595,17 @@ def liked_warbles(user_id):
         return redirect('/')
 
     user = User.query.get_or_404(user_id)
+    likes = (Message
+             .query
+             .options(db.joinedload(Message.user))
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user.id)
+             .order_by(Message.id.desc())
+             .all())
 
-    return render_template('/users/likes.html', user=user, likes=user.likes)
+    return render_template('/users/likes.html', user=user, likes=likes)
 
-@app.route('/users/warble_liking/<int:msg_id>', methods=['POST'])
+@bp.route('/users/warble_liking/<int:msg_id>', methods=['POST'])
 def warble_liking(msg_id):
     """Like/unlike a warble"""
 
@@ -286,13 +614,8 @@ def warble_liking(msg_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(msg_id)
-
-    if msg in g.user.likes:
-        g.user.remove_like(msg)
-
-    else:
-
-        g.user.add_like(msg)
+    current_user().toggle_like(msg)
+    db.session.commit()
 
     return redirect(f'/users/{ g.user.id }/likes')
 
@@ -303,7 +626,7 @@ def warble_liking(msg_id):
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -317,8 +640,22 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        # a worker sharing our id worker number (see snowflake.py) may have
+        # made the same id this millisecond; then take the next one
+        for attempt in range(POST_ATTEMPTS):
+            try:
+                with db.session.begin_nested():
+                    msg = Message(text=form.text.data, user_id=g.user.id)
+                    db.session.add(msg)
+                break
+            except IntegrityError:
+                logger.warning("message id %d already taken", msg.id)
+        else:
+            flash("Your message could not be posted; please try again.",
+                  'danger')
+            return render_template('messages/new.html', form=form), 503
+
+        fan_out_message(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -326,18 +663,49 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/search')
+def messages_search():
+    """Search message text; takes the query in the 'q' param."""
+
+    search = request.args.get('q', '').strip()
+
+    if not search:
+        return render_template('messages/search.html', search=search,
+                               messages=[], page=None)
+
+    try:
+        page = keyset_page(partial(search_messages, search),
+                           current_app.config['MESSAGES_PER_PAGE'],
+                           before=request.args.get('before'),
+                           after=request.args.get('after'),
+                           key=search_key,
+                           types=SEARCH_KEY_TYPES)
+    except InvalidCursor:
+        abort(400)
+
+    return render_template('messages/search.html', search=search,
+                           messages=page.items, page=page)
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
     msg = Message.query.get_or_404(message_id)
+
+    cached = not_modified(msg.id, msg.text, msg.user.id, msg.user.username,
+                          msg.user.image_url,
+                          msg.user.id in viewer_following_ids())
+    if cached is not None:
+        return cached
+
     return render_template('messages/show.html', message=msg)
 
-# @app.route('messages/<int:message_id>/like', methods=['POST'])
+# @bp.route('messages/<int:message_id>/like', methods=['POST'])
 # se
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -346,6 +714,7 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    remove_message(msg)
     db.session.delete(msg)
     db.session.commit()
 
@@ -356,41 +725,46 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users (and their own),
+      read from their materialized timeline a page at a time
     """
 
     if g.user:
-        messages = (Message
-                    .query
-                    .filter()
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        page = timeline_page(g.user.id)
+        likes = g.user.liked_message_ids(msg.id for msg in page.items)
 
-        return render_template('home.html', messages=messages)
+        return render_template('home.html', messages=page.items, page=page,
+                               likes=likes)
 
     else:
         return render_template('home-anon.html')
 
 
+@bp.route('/metrics')
+def show_metrics():
+    """Request, database and hashing metrics in Prometheus text format."""
+
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+##############################################################################
+# Caching headers: per-route rules are in caching.py
+
+
+@bp.after_app_request
+def add_header(response):
+    """Add Cache-Control and validators to pages that have none."""
+
+    return cache_headers(response)
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# The app for `flask run`, WSGI servers (app:app) and scripts that import it.
+
+app = create_app()
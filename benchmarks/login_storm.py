@@ -0,0 +1,139 @@
+"""Benchmark unrelated-route latency during a login storm.
+
+Simulates a fixed set of synchronous web workers (threads each handling one
+request at a time) and submits a burst of logins mixed with requests to an
+unrelated page. Runs once with bcrypt inline in the workers and once with
+the bounded hashing pool from passwords.py, and reports login throughput,
+how many logins were shed (503), and p50/p95/p99 latency of the unrelated
+route, queueing included.
+
+Run from the project root (this drops and recreates all tables):
+
+    DATABASE_URL=postgresql:///warbler-test python -m benchmarks.login_storm
+"""
+
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app
+from models import db, User, Message
+
+PASSWORD = "password"
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = max(0, int(round(pct / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def seed():
+    db.drop_all()
+    db.create_all()
+
+    user = User.signup("stormy", "stormy@test.com", PASSWORD, None)
+    db.session.commit()
+
+    db.session.add(Message(text="nothing to see here", user_id=user.id))
+    db.session.commit()
+
+    return Message.query.one().id
+
+
+def run_mode(label, workers, queue, args, message_id):
+    """Run one storm; `workers` = 0 hashes inline in the web workers."""
+
+    hasher = app.extensions.pop('password_hasher', None)
+    if hasher:
+        hasher.shutdown()
+
+    app.config['PASSWORD_HASH_WORKERS'] = workers
+    app.config['PASSWORD_HASH_QUEUE'] = queue
+
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        return local.client
+
+    def login(submitted):
+        resp = client().post("/login", data={"username": "stormy",
+                                             "password": PASSWORD})
+        return 'login', resp.status_code, time.perf_counter() - submitted
+
+    def unrelated(submitted):
+        resp = client().get(f"/messages/{message_id}")
+        return 'page', resp.status_code, time.perf_counter() - submitted
+
+    # interleave: one unrelated request after every `ratio` logins
+    jobs = []
+    for i in range(args.logins):
+        jobs.append(login)
+        if i % args.ratio == 0:
+            jobs.append(unrelated)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.web_workers) as web:
+        futures = [web.submit(job, time.perf_counter()) for job in jobs]
+        results = [f.result() for f in futures]
+    elapsed = time.perf_counter() - start
+
+    ok = [r for r in results if r[0] == 'login' and r[1] in (200, 302)]
+    shed = [r for r in results if r[0] == 'login' and r[1] == 503]
+    pages = [r[2] for r in results if r[0] == 'page']
+
+    return {
+        'mode': label,
+        'logins_ok': len(ok),
+        'logins_shed': len(shed),
+        'logins_per_sec': round(len(ok) / elapsed, 1),
+        'page_p50_ms': round(statistics.median(pages) * 1000, 1),
+        'page_p95_ms': round(percentile(pages, 95) * 1000, 1),
+        'page_p99_ms': round(percentile(pages, 99) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--ratio', type=int, default=4,
+                        help="logins per unrelated request")
+    parser.add_argument('--web-workers', type=int, default=8)
+    parser.add_argument('--hash-workers', type=int, default=2)
+    parser.add_argument('--hash-queue', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--json', help="also write results to this file")
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['BCRYPT_LOG_ROUNDS'] = args.rounds
+
+    message_id = seed()
+
+    results = [
+        run_mode('inline', 0, args.logins, args, message_id),
+        run_mode('pool', args.hash_workers, args.hash_queue, args, message_id),
+    ]
+
+    columns = list(results[0])
+    print("".join(f"{c:>15}" for c in columns))
+    for r in results:
+        print("".join(f"{r[c]:>15}" for c in columns))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
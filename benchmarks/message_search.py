@@ -0,0 +1,194 @@
+"""Benchmark message full-text search on a large seeded table.
+
+Seeds messages with text drawn from a skewed vocabulary (a few very common
+words, a long tail of rare ones), then reports how fast the search index is
+built (rows/sec for the generated tsvector column and for the GIN index),
+what incremental indexing costs a new post, and first-page/deep-page search
+latency for common, rare and multi-word queries.
+
+Run from the project root (this drops and recreates all tables):
+
+    DATABASE_URL=postgresql:///warbler-test python -m benchmarks.message_search
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+from functools import partial
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app
+from models import db, User, Message
+from pagination import keyset_page
+from search import search_messages, search_key, SEARCH_KEY_TYPES
+
+COMMON_WORDS = ["bird", "morning", "coffee", "today", "happy", "music",
+                "weekend", "friend", "travel", "work"]
+RARE_WORDS = [f"tok{i}" for i in range(20000)]
+
+QUERIES = {
+    'common': "bird",
+    'two common': "morning coffee",
+    'phrase': '"happy weekend"',
+    'rare': "tok19999",
+    'no match': "zebra",
+}
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = max(0, int(round(pct / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def summarize(latencies):
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+    }
+
+
+def seed(num_users, num_messages, batch):
+    """Fill the tables; return timings of the bulk load and index build."""
+
+    db.drop_all()
+    db.create_all()
+    db.session.execute("DROP INDEX ix_messages_search_vector")
+
+    db.session.execute(f"""
+        INSERT INTO users (email, username, password)
+        SELECT 'user' || g || '@test.com', 'user' || g, 'not-a-hash'
+        FROM generate_series(1, {num_users}) g""")
+    db.session.commit()
+
+    vocabulary = COMMON_WORDS + RARE_WORDS
+
+    # eight words per message; power() skews picks towards the front
+    load_start = time.perf_counter()
+    for first in range(1, num_messages + 1, batch):
+        last = min(first + batch - 1, num_messages)
+        db.session.execute(f"""
+            INSERT INTO messages (id, text, timestamp, user_id)
+            SELECT g,
+                   (SELECT string_agg(
+                        (:vocabulary)[1 + floor(power(random(), 4)
+                                               * {len(vocabulary)})::int],
+                        ' ')
+                    FROM generate_series(1, 8) w WHERE g > 0),
+                   timestamp '2015-01-01' + g * interval '2 minutes',
+                   1 + g % {num_users}
+            FROM generate_series({first}, {last}) g""",
+            {'vocabulary': vocabulary})
+        db.session.commit()
+    load = time.perf_counter() - load_start
+
+    index_start = time.perf_counter()
+    db.session.execute(
+        "CREATE INDEX ix_messages_search_vector "
+        "ON messages USING gin (search_vector)")
+    db.session.commit()
+    index = time.perf_counter() - index_start
+
+    db.session.execute("ANALYZE")
+    db.session.commit()
+
+    return {
+        'messages': num_messages,
+        'load_rows_per_sec': round(num_messages / load),
+        'gin_build_s': round(index, 2),
+        'gin_rows_per_sec': round(num_messages / index),
+    }
+
+
+def post_messages(count):
+    """Insert `count` messages one by one; return latencies."""
+
+    latencies = []
+
+    for i in range(count):
+        start = time.perf_counter()
+        db.session.add(Message(text=f"fresh bird warble tok{i}", user_id=1))
+        db.session.commit()
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+
+def run_query(text, per_page, pages, repeat):
+    """Latencies of the first page and of page `pages` for `text`."""
+
+    first, deep = [], []
+
+    for _ in range(repeat):
+        before = None
+        for number in range(1, pages + 1):
+            start = time.perf_counter()
+            page = keyset_page(partial(search_messages, text), per_page,
+                               before=before, key=search_key,
+                               types=SEARCH_KEY_TYPES)
+            elapsed = time.perf_counter() - start
+            db.session.rollback()
+
+            if number == 1:
+                first.append(elapsed)
+            if number == pages:
+                deep.append(elapsed)
+            if not page.older:
+                break
+            before = page.older
+
+    return first, deep
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=100000,
+                        help="messages per INSERT while seeding")
+    parser.add_argument('--posts', type=int, default=200,
+                        help="single posts timed against the live index")
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=5,
+                        help="page number reported as the deep page")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help="also write results to this file")
+    args = parser.parse_args()
+
+    with app.test_request_context():
+        build = seed(args.users, args.messages, args.batch)
+
+        print(f"loaded {build['messages']} messages at "
+              f"{build['load_rows_per_sec']} rows/s; GIN index built in "
+              f"{build['gin_build_s']}s ({build['gin_rows_per_sec']} rows/s)")
+
+        results = []
+        for label, text in QUERIES.items():
+            first, deep = run_query(text, args.per_page, args.pages,
+                                    args.repeat)
+            results.append(dict(query=label, page='first', **summarize(first)))
+            if deep:
+                results.append(dict(query=label, page=f'page {args.pages}',
+                                    **summarize(deep)))
+
+        results.append(dict(query='post', page='-',
+                            **summarize(post_messages(args.posts))))
+
+    print(f"{'query':<12}{'page':<9}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for r in results:
+        print(f"{r['query']:<12}{r['page']:<9}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['max_ms']:>10}")
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'build': build, 'results': results}, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
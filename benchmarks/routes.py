@@ -0,0 +1,299 @@
+"""Benchmark the main routes against generated data sets of several sizes.
+
+For each scale, generates a data set with generator/create_csvs.py (or
+reuses one from --data), bulk loads it, and replays a weighted mix of
+logged-in requests through the app: home page, profiles, the user
+directory, liking and login. Reports overall throughput and, per route,
+p50/p95/p99 latency and the number of SQL statements per request.
+
+Results go to a JSON file keyed by scale and route; pass an earlier file
+as --baseline to print the change in p95 latency and statement counts.
+
+Run from the project root (this drops and recreates all tables):
+
+    DATABASE_URL=postgresql:///warbler-test python -m benchmarks.routes \\
+        --scales small,medium --json routes-$(git rev-parse --short HEAD).json
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-test")
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from bulkload import load
+from migrations import stamp
+from models import db, User, Message
+from passwords import hash_password
+from timelines import rebuild_timelines
+
+PASSWORD = "password"
+
+SCALES = {
+    'tiny': dict(users=50, messages=200, follows=300, likes=300),
+    'small': dict(users=1000, messages=10000, follows=20000, likes=20000),
+    'medium': dict(users=10000, messages=100000, follows=200000,
+                   likes=200000),
+    'large': dict(users=100000, messages=1000000, follows=2000000,
+                  likes=2000000),
+}
+
+DEFAULT_MIX = "homepage=40,users_show=25,list_users=10,warble_liking=20,login=5"
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = max(0, int(round(pct / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def parse_mix(text):
+    """'route=weight,...' -> {route: weight}."""
+
+    mix = {}
+    for part in text.split(','):
+        route, weight = part.split('=')
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f"unknown route {route!r}")
+        mix[route] = float(weight)
+    return mix
+
+
+def dataset(scale, args):
+    """Directory holding the CSVs for `scale`, generating them if needed."""
+
+    directory = os.path.join(args.data, f"{scale}-{args.seed}")
+
+    if not os.path.exists(os.path.join(directory, 'users.csv')):
+        sizes = SCALES[scale]
+        subprocess.run([sys.executable, 'generator/create_csvs.py',
+                        '--out', directory, '--seed', args.seed,
+                        *(f"--{name}={count}" for name, count in sizes.items())],
+                       check=True, stdout=subprocess.DEVNULL)
+
+    return directory
+
+
+def seed(directory):
+    """Load a data set; every user's password becomes PASSWORD."""
+
+    db.drop_all()
+    db.create_all()
+    stamp()
+
+    load(db.engine, directory, report=lambda line: None)
+
+    db.session.query(User).update(
+        {User.password: hash_password(app, PASSWORD)},
+        synchronize_session=False)
+    User.reconcile_counters()
+    rebuild_timelines()
+    db.session.commit()
+
+
+##############################################################################
+# Requests. Each takes the test client, the logged-in user (id, username)
+# and the random generator, and makes one request.
+
+
+def homepage(client, viewer, rng, ids):
+    return client.get("/")
+
+
+def users_show(client, viewer, rng, ids):
+    return client.get(f"/users/{rng.choice(ids['users'])}")
+
+
+def list_users(client, viewer, rng, ids):
+    return client.get("/users")
+
+
+def warble_liking(client, viewer, rng, ids):
+    return client.post(f"/users/warble_liking/{rng.choice(ids['messages'])}")
+
+
+def login(client, viewer, rng, ids):
+    return client.post("/login", data={"username": viewer[1],
+                                       "password": PASSWORD})
+
+
+ROUTES = {route.__name__: route for route in
+          [homepage, users_show, list_users, warble_liking, login]}
+
+
+def replay(args, mix):
+    """Send args.requests requests in the proportions of `mix`; returns
+    (elapsed seconds, {route: [(latency, statements, status)]})."""
+
+    rng = random.Random(args.seed)
+
+    viewers = (db.session.query(User.id, User.username)
+               .order_by(db.func.random()).limit(args.viewers).all())
+    ids = {
+        'users': [id for id, _ in viewers],
+        'messages': [id for id, in (db.session.query(Message.id)
+                                    .order_by(db.func.random())
+                                    .limit(args.viewers))],
+    }
+    db.session.rollback()
+
+    statements = [0]
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements[0] += 1
+
+    client = app.test_client()
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    samples = defaultdict(list)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        start = time.perf_counter()
+
+        for number in range(args.warmup + args.requests):
+            route = rng.choices(routes, weights)[0]
+            viewer = rng.choice(viewers)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer[0]
+
+            statements[0] = 0
+            sent = time.perf_counter()
+            resp = ROUTES[route](client, viewer, rng, ids)
+            # streamed pages (/users) are only rendered as they are read,
+            # and hold a request context until closed
+            resp.get_data()
+            resp.close()
+            latency = time.perf_counter() - sent
+
+            if number == args.warmup:
+                start = sent
+            if number >= args.warmup:
+                samples[route].append((latency, statements[0],
+                                       resp.status_code))
+
+        elapsed = time.perf_counter() - start
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    return elapsed, samples
+
+
+def summarize(samples):
+    latencies = [latency for latency, _, _ in samples]
+    statements = [count for _, count, _ in samples]
+
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, _, status in samples if status >= 400),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'statements_mean': round(statistics.mean(statements), 1),
+        'statements_max': max(statements),
+    }
+
+
+def compare(results, baseline):
+    """Print p95 and statement-count changes against `baseline`."""
+
+    print(f"\nchange from baseline {baseline.get('commit', '?')}:")
+    print(f"{'scale':<8}{'route':<15}{'p95 ms':>16}{'statements':>16}")
+
+    for scale, result in results['scales'].items():
+        for route, now in result['routes'].items():
+            before = baseline['scales'].get(scale, {}).get('routes', {}).get(route)
+            if not before:
+                continue
+            print(f"{scale:<8}{route:<15}"
+                  f"{before['p95_ms']:>7} -> {now['p95_ms']:<6}"
+                  f"{before['statements_mean']:>7} -> "
+                  f"{now['statements_mean']:<6}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', default='small',
+                        help=f"comma-separated, from {', '.join(SCALES)}")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="route=weight pairs (default: %(default)s)")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--viewers', type=int, default=500,
+                        help="distinct logged-in users to send requests as")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--rounds', type=int, default=12,
+                        help="BCRYPT_LOG_ROUNDS for the login route")
+    parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(),
+                                                       'warbler-benchmarks'),
+                        help="where generated data sets are kept and reused")
+    parser.add_argument('--json', help="also write results to this file")
+    parser.add_argument('--baseline', help="earlier --json file to compare to")
+    args = parser.parse_args()
+
+    scales = args.scales.split(',')
+    for scale in scales:
+        if scale not in SCALES:
+            parser.error(f"unknown scale {scale!r}")
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['BCRYPT_LOG_ROUNDS'] = args.rounds
+
+    results = {'commit': git_commit(), 'mix': args.mix, 'scales': {}}
+
+    print(f"{'scale':<8}{'route':<15}{'reqs':>6}{'errors':>7}{'p50 ms':>9}"
+          f"{'p95 ms':>9}{'p99 ms':>9}{'stmts':>7}")
+
+    for scale in scales:
+        with app.test_request_context():
+            seed(dataset(scale, args))
+            elapsed, samples = replay(args, args.mix)
+
+        routes = {route: summarize(samples[route]) for route in args.mix
+                  if samples[route]}
+        results['scales'][scale] = {
+            'dataset': SCALES[scale],
+            'throughput_rps': round(args.requests / elapsed, 1),
+            'routes': routes,
+        }
+
+        for route, r in routes.items():
+            print(f"{scale:<8}{route:<15}{r['requests']:>6}{r['errors']:>7}"
+                  f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}"
+                  f"{r['statements_mean']:>7}")
+        print(f"{scale:<8}{'(all)':<15}"
+              f"{results['scales'][scale]['throughput_rps']} requests/s")
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as previous:
+            compare(results, json.load(previous))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Benchmark push vs. hybrid timelines across the follower distribution.
+
+Posts messages as a low-follower and a high-follower author and reads the
+timeline of someone following both, once with pure fan-out (push) and once
+with the hybrid push/pull mode. Reports write amplification (timeline rows
+inserted per post) and post/read latency.
+
+Run from the project root (this drops and recreates all tables):
+
+    DATABASE_URL=postgresql:///warbler-test python -m benchmarks.timeline_fanout
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-test")
+
+from app import app
+from models import db, User, Message, Follows, TimelineEntry
+from timelines import (fan_out_message, timeline_messages,
+                       clear_high_follower_cache)
+
+CELEBRITY_ID = 1
+REGULAR_ID = 2
+READER_ID = 3
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of `samples` (nearest rank)."""
+
+    ordered = sorted(samples)
+    index = max(0, int(round(pct / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def seed(num_followers, regular_followers):
+    """Create a celebrity with `num_followers` and a regular account."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(User.__table__.insert(), [
+        dict(id=i, username=f"user{i}", email=f"user{i}@test.com",
+             password="not-a-real-hash")
+        for i in range(1, num_followers + 3)
+    ])
+
+    follows = [dict(user_being_followed_id=CELEBRITY_ID, user_following_id=i)
+               for i in range(3, num_followers + 3)]
+    follows += [dict(user_being_followed_id=REGULAR_ID, user_following_id=i)
+                for i in range(3, regular_followers + 3)]
+    db.session.execute(Follows.__table__.insert(), follows)
+
+    # the raw inserts skip the counter hooks; the high-follower set reads
+    # follower_count
+    User.reconcile_counters()
+    db.session.commit()
+
+
+def post_messages(author_id, count):
+    """Post `count` messages as `author_id`; return (latencies, rows/post)."""
+
+    latencies = []
+    rows_before = TimelineEntry.query.count()
+
+    for i in range(count):
+        start = time.perf_counter()
+        msg = Message(text=f"benchmark warble {i}", user_id=author_id)
+        db.session.add(msg)
+        db.session.flush()
+        fan_out_message(msg)
+        db.session.commit()
+        latencies.append(time.perf_counter() - start)
+
+    rows_after = TimelineEntry.query.count()
+    return latencies, (rows_after - rows_before) / count
+
+
+def read_timeline(user_id, count):
+    """Read `user_id`'s timeline `count` times; return latencies."""
+
+    latencies = []
+
+    for _ in range(count):
+        start = time.perf_counter()
+        timeline_messages(user_id, limit=100)
+        latencies.append(time.perf_counter() - start)
+        db.session.rollback()
+
+    return latencies
+
+
+def summarize(latencies):
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+    }
+
+
+def run(args):
+    results = []
+
+    for mode, threshold in [('push', args.followers * 10),
+                            ('hybrid', args.threshold)]:
+        with app.test_request_context():
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = threshold
+            seed(args.followers, args.regular_followers)
+            clear_high_follower_cache()
+
+            for author, label in [(REGULAR_ID, 'regular'),
+                                  (CELEBRITY_ID, 'celebrity')]:
+                latencies, amplification = post_messages(author, args.posts)
+                if author == CELEBRITY_ID and args.followers > threshold:
+                    assert amplification == 1, (
+                        f"hybrid mode fanned out celebrity posts "
+                        f"({amplification} rows per post)")
+                results.append(dict(mode=mode, author=label, op='post',
+                                    rows_per_post=amplification,
+                                    **summarize(latencies)))
+
+            latencies = read_timeline(READER_ID, args.reads)
+            results.append(dict(mode=mode, author='reader', op='read',
+                                **summarize(latencies)))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--followers', type=int, default=20000,
+                        help="followers of the high-follower account")
+    parser.add_argument('--regular-followers', type=int, default=50,
+                        help="followers of the regular account")
+    parser.add_argument('--threshold', type=int, default=1000,
+                        help="TIMELINE_FANOUT_THRESHOLD for hybrid mode")
+    parser.add_argument('--posts', type=int, default=20)
+    parser.add_argument('--reads', type=int, default=200)
+    parser.add_argument('--json', help="also write results to this file")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print(f"{'mode':<8}{'author':<11}{'op':<6}{'rows/post':>10}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for r in results:
+        print(f"{r['mode']:<8}{r['author']:<11}{r['op']:<6}"
+              f"{r.get('rows_per_post', ''):>10}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['max_ms']:>10}")
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""Stream CSV files into the database in bulk.
+
+Each file is read in chunks of `chunk_rows` rows, so memory stays flat no
+matter how big the file is. On PostgreSQL every chunk goes in with
+COPY FROM STDIN; elsewhere (SQLite) it is a batched executemany.
+
+Secondary indexes and foreign keys are dropped for the duration of the
+load and put back afterwards: building an index once over the finished
+table, and checking every foreign key in one pass, is far cheaper than
+doing both row by row. Sequences are then moved past the loaded ids.
+
+Message ids are time-ordered (see snowflake.py). A messages.csv without an
+id column is numbered by position, which is how likes.csv refers to it,
+and then renumbered from the timestamps with renumber_messages().
+
+Run from the project root, against an existing schema:
+
+    python bulkload.py generator/      # users.csv, messages.csv, ... likes.csv
+"""
+
+import csv
+import os
+import sys
+import time
+from contextlib import contextmanager
+from io import StringIO
+from itertools import islice
+
+from sqlalchemy import inspect, text
+
+from snowflake import EPOCH_MS, TIME_SHIFT
+
+DEFAULT_CHUNK_ROWS = 50000
+
+# In load order: a file may only refer to rows of the files before it.
+TABLE_FILES = [
+    ('users', 'users.csv'),
+    ('messages', 'messages.csv'),
+    ('follows', 'follows.csv'),
+    ('likes', 'likes.csv'),
+]
+
+
+class BulkLoadError(Exception):
+    """The loaded rows break a constraint that was deferred."""
+
+
+def read_chunks(path, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Yield (columns, rows) from a CSV file with a header, `chunk_rows`
+    rows at a time."""
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                return
+            yield columns, rows
+
+
+def copy_rows(conn, table, columns, rows):
+    """Send `rows` to `table` with one COPY (PostgreSQL)."""
+
+    buffer = StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) "
+                       f"FROM STDIN WITH (FORMAT csv)", buffer)
+    cursor.close()
+
+
+def insert_rows(conn, table, columns, rows):
+    """Send `rows` to `table` with one executemany."""
+
+    params = [f"p{i}" for i in range(len(columns))]
+    statement = text(f"INSERT INTO {table} ({', '.join(columns)}) "
+                     f"VALUES ({', '.join(':' + p for p in params)})")
+
+    # empty fields are NULL, as they are for COPY
+    conn.execute(statement, [{p: value or None for p, value in zip(params, row)}
+                             for row in rows])
+
+
+@contextmanager
+def deferred_constraints(conn, tables):
+    """Drop the secondary indexes and foreign keys of `tables`, and
+    recreate them on leaving the block.
+
+    Indexes backing a primary key or unique constraint stay: the load
+    relies on them to reject duplicates.
+    """
+
+    if conn.dialect.name == 'postgresql':
+        indexes = conn.execute(text(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE tablename = ANY(:tables) "
+            "AND schemaname = current_schema() "
+            "AND indexname NOT IN (SELECT conname FROM pg_constraint)"),
+            tables=list(tables)).fetchall()
+        foreign_keys = conn.execute(text(
+            "SELECT conrelid::regclass::text, conname, "
+            "pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE contype = 'f' AND conrelid::regclass::text = ANY(:tables)"),
+            tables=list(tables)).fetchall()
+    else:
+        # SQLite only checks foreign keys when asked to; see the end
+        indexes = [(name, definition) for name, table, definition
+                   in conn.execute("SELECT name, tbl_name, sql "
+                                   "FROM sqlite_master WHERE type = 'index' "
+                                   "AND sql IS NOT NULL")
+                   if table in tables]
+        foreign_keys = []
+
+    for table, name, _ in foreign_keys:
+        conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT {name}")
+    for name, _ in indexes:
+        conn.execute(f"DROP INDEX {name}")
+
+    yield
+
+    for _, definition in indexes:
+        conn.execute(definition)
+    for table, name, definition in foreign_keys:
+        conn.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+
+    if conn.dialect.name == 'sqlite':
+        broken = conn.execute("PRAGMA foreign_key_check").fetchall()
+        if broken:
+            raise BulkLoadError(f"{len(broken)} rows with dangling foreign "
+                                f"keys, first in {broken[0][0]}")
+
+
+def renumber_messages(conn):
+    """Give every message a time-ordered id made from its timestamp, and
+    move likes and timeline entries over to the new ids.
+
+    Timestamps are cut to the millisecond, so that timestamp_of(id) gives
+    them back. Messages of the same millisecond are numbered in
+    (timestamp, old id) order. Foreign keys to messages must be dropped
+    first (see deferred_constraints()), and the old ids must be small: the
+    new ones may not clash with them.
+    """
+
+    if conn.dialect.name == 'postgresql':
+        ms = (f"round(extract(epoch FROM date_trunc('milliseconds', "
+              f"timestamp)) * 1000)::bigint - {EPOCH_MS}")
+        truncated = "date_trunc('milliseconds', {0})"
+    else:
+        ms = (f"CAST(strftime('%s', substr(timestamp, 1, 19)) AS INTEGER) "
+              f"* 1000 + CAST(substr(timestamp || '.000', 21, 3) AS INTEGER) "
+              f"- {EPOCH_MS}")
+        truncated = "substr({0} || '.000', 1, 23) || '000'"
+
+    conn.execute(f"""
+        CREATE TEMPORARY TABLE message_renumbering AS
+        SELECT id AS old_id,
+               (ms << {TIME_SHIFT}) + row_number() OVER (
+                   PARTITION BY ms ORDER BY timestamp, id) - 1 AS new_id
+        FROM (SELECT id, timestamp, {ms} AS ms FROM messages) AS stamped""")
+    conn.execute("CREATE INDEX message_renumbering_old_id "
+                 "ON message_renumbering (old_id)")
+
+    for table in ['likes', 'timelines']:
+        conn.execute(f"""
+            UPDATE {table} SET message_id = new_id
+            FROM message_renumbering WHERE message_id = old_id""")
+
+    conn.execute(f"""
+        UPDATE timelines SET timestamp = {truncated.format('timestamp')}""")
+    conn.execute(f"""
+        UPDATE messages
+        SET id = new_id, timestamp = {truncated.format('timestamp')}
+        FROM message_renumbering WHERE id = old_id""")
+
+    conn.execute("DROP TABLE message_renumbering")
+
+
+def reset_sequences(conn, tables):
+    """Move the id sequence of each of `tables` past its largest id.
+
+    Tables without a serial `id` column (follows, messages) are skipped.
+    """
+
+    if conn.dialect.name != 'postgresql':
+        return      # SQLite takes max(rowid) + 1 by itself
+
+    for table in tables:
+        columns = inspect(conn).get_columns(table)
+        if 'id' not in {column['name'] for column in columns}:
+            continue
+
+        sequence = conn.execute(
+            text("SELECT pg_get_serial_sequence(:table, 'id')"),
+            table=table).scalar()
+        if sequence is None:
+            continue
+
+        conn.execute(
+            text(f"SELECT setval(:sequence, coalesce(max(id), 0) + 1, false) "
+                 f"FROM {table}"),
+            sequence=sequence)
+
+
+def load(engine, directory, chunk_rows=DEFAULT_CHUNK_ROWS, report=print):
+    """Load every file of TABLE_FILES found in `directory`, in one
+    transaction. Returns {table: rows loaded}."""
+
+    files = [(table, os.path.join(directory, name))
+             for table, name in TABLE_FILES
+             if os.path.exists(os.path.join(directory, name))]
+    tables = [table for table, _ in files]
+    loaded = {}
+    renumber = False
+
+    with engine.begin() as conn:
+        write = copy_rows if conn.dialect.name == 'postgresql' else insert_rows
+
+        with deferred_constraints(conn, tables):
+            for table, path in files:
+                start = time.perf_counter()
+                loaded[table] = 0
+
+                for columns, rows in read_chunks(path, chunk_rows):
+                    if table == 'messages' and 'id' not in columns:
+                        # by position for now; see renumber_messages()
+                        columns = ['id'] + columns
+                        rows = [[loaded[table] + i] + row
+                                for i, row in enumerate(rows, 1)]
+                        renumber = True
+
+                    write(conn, table, columns, rows)
+                    loaded[table] += len(rows)
+
+                    elapsed = time.perf_counter() - start
+                    report(f"{table}: {loaded[table]:,} rows "
+                           f"({loaded[table] / elapsed:,.0f} rows/s)")
+
+            if renumber:
+                start = time.perf_counter()
+                renumber_messages(conn)
+                report(f"renumbered messages in "
+                       f"{time.perf_counter() - start:.1f}s")
+
+            start = time.perf_counter()
+            report("rebuilding indexes and foreign keys")
+
+        report(f"rebuilt in {time.perf_counter() - start:.1f}s")
+        reset_sequences(conn, tables)
+
+        if conn.dialect.name == 'postgresql':
+            conn.execute(f"ANALYZE {', '.join(tables)}")
+
+    return loaded
+
+
+if __name__ == '__main__':
+    from app import app
+    from models import db
+
+    if len(sys.argv) != 2:
+        sys.exit("usage: python bulkload.py DIRECTORY")
+
+    with app.app_context():
+        load(db.engine, sys.argv[1])
@@ -0,0 +1,182 @@
+"""HTTP caching rules for Warbler.
+
+Static files are linked by fingerprinted names: static_url() turns
+'stylesheets/style.css' into '/static/stylesheets/style.<hash>.css', where
+<hash> comes from the file's contents. A URL like that never changes
+meaning, so it is served as public and immutable for a year. The plain
+name still works; it must be revalidated on every use (Flask's static
+view already gives it an ETag). So does a fingerprint left over from
+older contents, served with the current file.
+
+Pages are not stored by anything without asking first (`no-cache`), and
+pages for a logged-in user, or that set a cookie, stay out of shared
+caches (`private`); all vary on the session cookie. GET pages that are
+not streamed get a strong ETag made from their body, so an unchanged page
+costs a render but no bandwidth.
+Views whose content is cheap to describe can do better with
+not_modified(): a weak ETag from the data the page shows, checked before
+rendering, so an unchanged page skips the render too.
+"""
+
+import hashlib
+import os
+import re
+
+from flask import (Response, current_app, g, request, send_from_directory,
+                   session)
+from werkzeug.http import is_resource_modified
+
+FINGERPRINTED = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{12})'
+                           r'(?P<extension>\.[^./]+)$')
+
+DEFAULT_STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+class StaticAssets:
+    """Fingerprinted URLs for the files in the app's static folder."""
+
+    def __init__(self):
+        self._fingerprints = {}     # path -> (mtime, size, hash)
+
+    def init_app(self, app):
+        app.config.setdefault('STATIC_MAX_AGE', DEFAULT_STATIC_MAX_AGE)
+
+        app.view_functions['static'] = self.send
+        app.add_template_global(self.url, 'static_url')
+        app.add_template_filter(self.url, 'static_url')
+
+    def fingerprint(self, filename):
+        """Hash of the contents of static/`filename`, or None if there is
+        no such file."""
+
+        path = os.path.join(current_app.static_folder, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        known = self._fingerprints.get(path)
+        if known and known[:2] == (stat.st_mtime, stat.st_size):
+            return known[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as contents:
+            for block in iter(lambda: contents.read(65536), b''):
+                digest.update(block)
+
+        fingerprint = digest.hexdigest()[:12]
+        self._fingerprints[path] = (stat.st_mtime, stat.st_size, fingerprint)
+        return fingerprint
+
+    def url(self, filename):
+        """Fingerprinted URL of a static file.
+
+        Takes a name within the static folder or a '/static/...' URL, as
+        stored in image_url columns; any other URL comes back unchanged.
+        """
+
+        if not filename:
+            return filename
+
+        prefix = current_app.static_url_path + '/'
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):]
+        elif '//' in filename or filename.startswith('/'):
+            return filename
+
+        fingerprint = self.fingerprint(filename)
+        if fingerprint is None:
+            return prefix + filename
+
+        stem, extension = os.path.splitext(filename)
+        return f"{prefix}{stem}.{fingerprint}{extension}"
+
+    def send(self, filename):
+        """The static view, for plain and fingerprinted names."""
+
+        match = FINGERPRINTED.match(filename)
+        if match:
+            plain = match['stem'] + match['extension']
+            if match['hash'] == self.fingerprint(plain):
+                response = send_from_directory(current_app.static_folder,
+                                               plain)
+                response.headers['Cache-Control'] = (
+                    f"public, max-age={current_app.config['STATIC_MAX_AGE']}"
+                    f", immutable")
+                return response
+
+            if self.fingerprint(plain) is not None:
+                filename = plain
+
+        response = send_from_directory(current_app.static_folder, filename)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+
+static_assets = StaticAssets()
+
+
+def not_modified(*parts):
+    """Check the client's copy of the page before rendering it.
+
+    `parts` are everything the page shows, e.g. ids and columns; who is
+    logged in is added here. They make a weak ETag, sent with the page.
+    Returns a 304 response when the client's copy matches, else None and
+    the view renders as usual.
+
+    There is deliberately no Last-Modified: no single time covers every
+    input of a page (a profile edit, a follow, a deleted message), and a
+    client that only sends If-Modified-Since would be told a stale page is
+    current.
+
+    Pages carrying flashed messages are never validated.
+    """
+
+    if '_flashes' in session:
+        return None
+
+    viewer = (g.user.id, g.user.username, g.user.image_url) if g.user else None
+    digest = hashlib.sha1(repr((request.full_path, viewer) + parts).encode())
+    g.etag = f'W/"{digest.hexdigest()}"'
+
+    if is_resource_modified(request.environ, etag=g.etag):
+        return None
+
+    response = Response(status=304)
+    add_validators(response)
+    return response
+
+
+def add_validators(response):
+    """Put the validator set by not_modified() on `response`."""
+
+    response.headers['ETag'] = g.etag
+
+
+def cache_headers(response):
+    """Cache-Control, and validators, for pages that did not set their own.
+
+    Runs after every request.
+    """
+
+    if 'Cache-Control' in response.headers:
+        return response
+
+    response.vary.add('Cookie')
+    # the session cookie is only added after this runs
+    if (g.get('user') or session.modified
+            or 'Set-Cookie' in response.headers):
+        response.headers['Cache-Control'] = 'private, no-cache'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+
+    if request.method != 'GET' or response.status_code != 200:
+        return response
+
+    if g.get('etag'):
+        add_validators(response)
+    elif not response.is_streamed:
+        response.add_etag()
+        response.make_conditional(request)
+
+    return response
@@ -0,0 +1,284 @@
+"""Change events for Warbler's caches.
+
+Writes to users, messages, follows and likes are recorded as typed events
+while a transaction runs: ORM flushes by models.record_flush_changes(),
+Core statements (follows, likes, counters) by the code that runs them, via
+record(). Events are coalesced per transaction, one per row, and nothing
+is delivered unless the transaction commits.
+
+After the commit, handlers registered with subscribe() get the events in
+this process. On PostgreSQL the same events also go to every other worker:
+they are sent with NOTIFY as part of the commit, and each process LISTENs
+on a connection of its own in a background thread. Handlers run with an
+app context but must not write to the database; they are meant to drop
+cached copies.
+"""
+
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger('warbler.changes')
+
+DEFAULT_CHANNEL = 'warbler_changes'
+MAX_PAYLOAD = 7900          # PostgreSQL refuses NOTIFY payloads of 8000+
+RECONNECT_DELAY = 1         # seconds
+
+
+class UserChanged(namedtuple('UserChanged', 'user_id username deleted')):
+    """A user was added, edited or deleted, or their counters changed
+    (then `username` is None)."""
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self.user_id
+
+
+class MessageChanged(namedtuple('MessageChanged',
+                                'message_id author_id deleted')):
+    """A message was posted or deleted."""
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self.message_id
+
+
+class FollowChanged(namedtuple('FollowChanged',
+                               'follower_id followed_id deleted')):
+    """A user started or stopped following another."""
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self.follower_id, self.followed_id
+
+
+class LikeChanged(namedtuple('LikeChanged', 'user_id message_id deleted')):
+    """A user liked or unliked a message."""
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self.user_id, self.message_id
+
+
+class FanoutChanged(namedtuple('FanoutChanged', 'user_id pulled')):
+    """An account crossed the fan-out threshold: its messages are now
+    pulled at read time (`pulled`), or pushed again."""
+
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self.user_id
+
+
+EVENT_TYPES = {cls.__name__: cls for cls in
+               [UserChanged, MessageChanged, FollowChanged, LikeChanged,
+                FanoutChanged]}
+
+
+def coalesce(pending, events):
+    """Add `events` to `pending`, a {(type, key): event} dict.
+
+    A later event for the same row replaces the earlier one, except that
+    fields it leaves as None keep their earlier value.
+    """
+
+    for change in events:
+        slot = (type(change), change.key)
+        earlier = pending.get(slot)
+        if earlier is not None:
+            change = earlier._replace(**{
+                field: value for field, value in change._asdict().items()
+                if value is not None})
+        pending[slot] = change
+
+
+def record(session, *events):
+    """Record `events` in the transaction of `session`, to be delivered if
+    it commits."""
+
+    coalesce(session.info.setdefault('changes', {}), events)
+
+
+def encode(events):
+    """NOTIFY payloads for `events`: JSON [sender pid, [event, ...]], each
+    under MAX_PAYLOAD bytes."""
+
+    payloads, items, size = [], [], 0
+
+    def payload():
+        return f"[{os.getpid()},[{','.join(items)}]]"
+
+    for change in events:
+        item = json.dumps([type(change).__name__, *change])
+        if items and size + len(item) > MAX_PAYLOAD:
+            payloads.append(payload())
+            items, size = [], 0
+        items.append(item)
+        size += len(item) + 1
+
+    if items:
+        payloads.append(payload())
+
+    return payloads
+
+
+def decode(payload):
+    """(sender pid, events) from a payload made by encode()."""
+
+    sender, items = json.loads(payload)
+    return sender, [EVENT_TYPES[name](*fields) for name, *fields in items]
+
+
+class ChangeBus:
+    """Delivers committed changes to subscribed handlers."""
+
+    def __init__(self):
+        self._handlers = {}         # event type -> [handler, ...]
+        self._listener = None
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+        event.listen(Session, 'before_commit', self._before_commit)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_transaction_end', self._transaction_end)
+
+    def init_app(self, app):
+        app.config.setdefault('CHANGES_CHANNEL', DEFAULT_CHANNEL)
+        app.config.setdefault('CHANGES_NOTIFY', True)
+
+        app.before_request(self._start_listener)
+
+    def subscribe(self, event_type, handler):
+        """Call `handler(event)` for every committed `event_type` change."""
+
+        self._handlers.setdefault(event_type, []).append(handler)
+
+    def unsubscribe(self, event_type, handler):
+        self._handlers[event_type].remove(handler)
+
+    def publish(self, events):
+        """Hand `events` to their handlers, here in this process."""
+
+        for change in events:
+            for handler in self._handlers.get(type(change), ()):
+                try:
+                    handler(change)
+                except Exception:
+                    logger.exception("change handler %r failed on %r",
+                                     handler, change)
+
+    def _notifying(self, session):
+        if not has_app_context() or not current_app.config.get(
+                'CHANGES_NOTIFY'):
+            return False
+        return session.get_bind().dialect.name == 'postgresql'
+
+    def _before_commit(self, session):
+        if session.transaction.nested or not self._notifying(session):
+            return
+
+        # flush now, so the events of the last flush go out too
+        session.flush()
+        pending = session.info.get('changes')
+        if not pending:
+            return
+
+        for payload in encode(pending.values()):
+            session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                            {'channel': current_app.config['CHANGES_CHANNEL'],
+                             'payload': payload})
+
+    def _after_commit(self, session):
+        pending = session.info.pop('changes', None)
+        if pending:
+            self.publish(pending.values())
+
+    def _transaction_end(self, session, transaction):
+        if transaction.parent is None:
+            session.info.pop('changes', None)   # rolled back
+
+    def _start_listener(self):
+        """Listen for other workers' changes, once per process."""
+
+        if self._listener_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+
+            app = current_app._get_current_object()
+            engine = app.extensions['sqlalchemy'].db.engine
+            if (not app.config['CHANGES_NOTIFY']
+                    or engine.dialect.name != 'postgresql'):
+                return
+
+            self._listener = threading.Thread(
+                target=self._listen, args=(app, engine),
+                name='warbler-changes', daemon=True)
+            self._listener.start()
+
+    def _listen(self, app, engine):
+        """Deliver other processes' notifications here, for good."""
+
+        channel = app.config['CHANGES_CHANNEL']
+
+        while True:
+            dbapi_connection = None
+
+            try:
+                # a connection of our own, out of the pool
+                connection = engine.raw_connection()
+                connection.detach()
+                dbapi_connection = connection.connection
+
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{channel}"')
+
+                while True:
+                    select.select([dbapi_connection], [], [])
+                    self._deliver(app, dbapi_connection)
+
+            except Exception:
+                logger.exception("lost the %s listener; reconnecting",
+                                 channel)
+                time.sleep(RECONNECT_DELAY)
+
+            finally:
+                if dbapi_connection is not None:
+                    dbapi_connection.close()
+
+    def _deliver(self, app, dbapi_connection):
+        dbapi_connection.poll()
+        pending = {}
+
+        while dbapi_connection.notifies:
+            sender, events = decode(dbapi_connection.notifies.pop(0).payload)
+            if sender != os.getpid():
+                coalesce(pending, events)
+
+        if pending:
+            with app.app_context():
+                self.publish(pending.values())
+
+
+changes = ChangeBus()
@@ -0,0 +1,167 @@
+"""Cache of rendered message items and user cards.
+
+Timelines, search results and user lists render the same markup for a
+message or a user on every page they appear on. This keeps the rendered
+HTML in a per-process LRU bounded by FRAGMENT_CACHE_BYTES, keyed by the
+entity's id and a version stamp: the columns the fragment shows. An author
+who edits their profile therefore never gets a stale fragment, even from a
+worker that did not see the edit; dropping the entries of edited and
+deleted users and messages (see changes.py) only frees the memory early.
+
+Fragments hold nothing that depends on who is looking. Viewer-specific
+parts (like and follow buttons) are rendered by the page and passed in as
+`actions`, which fill the fragment's ACTIONS slot.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+from changes import changes, MessageChanged, UserChanged
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+# where a fragment's template puts the viewer's buttons
+ACTIONS = '<!--actions-->'
+
+# columns shown by each kind of fragment, which make its version stamp
+MESSAGE_VERSION = ['text', 'timestamp']
+AUTHOR_VERSION = ['username', 'image_url']
+CARD_VERSION = ['username', 'image_url', 'header_image_url', 'bio']
+
+
+class FragmentCache:
+    """LRU of rendered fragments, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # (kind, id) -> (version, parts,
+                                        #                size, user id)
+        self._by_user = {}              # user id -> {(kind, id), ...}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_BYTES', DEFAULT_MAX_BYTES)
+        self.max_bytes = app.config['FRAGMENT_CACHE_BYTES']
+
+        app.add_template_global(self.message_item)
+        app.add_template_global(self.user_card)
+
+    def render(self, kind, id, version, user_id, template_name, actions='',
+               **context):
+        """`template_name` rendered with `context`, from the cache when
+        (kind, id) is there at `version`; `actions` fill its ACTIONS slot.
+
+        `user_id` is the user the fragment shows or who wrote it, for
+        forget_user().
+        """
+
+        key = (kind, id)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                parts = entry[1]
+            else:
+                parts = None
+
+        if parts is None:
+            html = current_app.jinja_env.get_template(template_name).render(
+                **context)
+            parts = (html.split(ACTIONS, 1) + [''])[:2]
+            self._store(key, version, user_id, parts)
+
+        return Markup(parts[0]) + actions + Markup(parts[1])
+
+    def _store(self, key, version, user_id, parts):
+        size = sum(len(part.encode()) for part in parts)
+
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (version, parts, size, user_id)
+            self._by_user.setdefault(user_id, set()).add(key)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        _, _, size, user_id = entry
+        self._bytes -= size
+
+        keys = self._by_user.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[user_id]
+
+    def message_item(self, msg, actions=''):
+        """A message in a list: avatar, author, date and text."""
+
+        version = (tuple(getattr(msg, column) for column in MESSAGE_VERSION)
+                   + tuple(getattr(msg.user, column)
+                           for column in AUTHOR_VERSION))
+        return self.render('message', msg.id, version, msg.user_id,
+                           'messages/item.html', actions, msg=msg)
+
+    def user_card(self, user, actions=''):
+        """A user in a grid of cards: header image, avatar, name and bio."""
+
+        version = tuple(getattr(user, column) for column in CARD_VERSION)
+        return self.render('user', user.id, version, user.id,
+                           'users/card.html', actions, user=user)
+
+    def forget_message(self, message_id):
+        with self._lock:
+            self._discard(('message', message_id))
+
+    def forget_user(self, user_id):
+        """Drop the card of `user_id` and the messages they wrote."""
+
+        with self._lock:
+            for key in list(self._by_user.get(user_id, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """Bytes of HTML held."""
+
+        return self._bytes
+
+
+fragment_cache = FragmentCache()
+
+
+def forget_changed_user(change):
+    # counter updates (no username) do not show in fragments
+    if change.deleted or change.username is not None:
+        fragment_cache.forget_user(change.user_id)
+
+
+def forget_deleted_message(change):
+    if change.deleted:
+        fragment_cache.forget_message(change.message_id)
+
+
+changes.subscribe(UserChanged, forget_changed_user)
+changes.subscribe(MessageChanged, forget_deleted_message)
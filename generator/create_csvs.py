@@ -3,75 +3,317 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Rows are generated in fixed-size shards, spread over worker processes and
+written straight to disk, so memory use does not grow with the data set.
+Every shard draws from its own generator seeded from --seed, so the same
+arguments give the same files whatever the number of workers. It runs
+offline: header images come from the local pool in header_images.txt.
+
+Activity is heavy-tailed like on a real site: who gets followed, who
+posts and who likes follow power laws (--follower-skew, --activity-skew,
+--like-skew; 0 is uniform), and a --burstiness share of messages cluster
+around a few news events. Sampling is done with NumPy, a shard at a time.
+likes.csv refers to messages by their position in messages.csv;
+bulkload.py turns those into the messages' time-ordered ids.
+
+Run from the project root:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 20000000 --out /tmp/warbler-data
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+import time
+from datetime import date, datetime, time as day_start
+from functools import lru_cache
+from multiprocessing import Pool
+
+import numpy as np
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_bursts, get_random_datetimes, seed_from, zipf_weights
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 3000
+NUM_BURSTS = 50
 
-fake = Faker()
+SHARD_ROWS = 100000
 
-# Generate random profile image URLs to use for users
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-image_urls = [
+# Random profile image URLs to use for users
+
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+HEADER_IMAGES_FILE = os.path.join(os.path.dirname(__file__),
+                                  'header_images.txt')
+
+
+def load_header_image_urls():
+    """Header image URLs from the local pool."""
+
+    with open(HEADER_IMAGES_FILE) as pool:
+        return [line.strip() for line in pool if line.strip()]
+
+
+@lru_cache(maxsize=None)
+def weights(seed, name, count, skew):
+    """Power-law weights of `count` users or messages, the same in every
+    worker for the same arguments."""
+
+    rng = np.random.default_rng(seed_from(seed, name))
+    return zipf_weights(count, skew, rng)
+
+
+@lru_cache(maxsize=None)
+def bursts(seed, until):
+    rng = np.random.default_rng(seed_from(seed, 'bursts'))
+    return get_bursts(rng, NUM_BURSTS, until)
+
+
+def sample_pairs(rng, count, draw, limit, same_ids=False):
+    """`count` distinct (a, b) pairs from `draw(size)`, which returns two
+    arrays of ids, b no more than `limit`; sorted by a.
+
+    With `same_ids` both are user ids and pairs with a == b are left out.
+    """
+
+    keys = np.empty(0, dtype=np.int64)
+
+    while len(keys) < count:
+        first, second = draw(2 * (count - len(keys)))
+        fresh = first * (limit + 1) + second
+        if same_ids:
+            fresh = fresh[first != second]
+        keys = np.unique(np.concatenate([keys, fresh]))
+
+    keys = np.sort(rng.permutation(keys)[:count])
+    return np.divmod(keys, limit + 1)
+
+
+def user_rows(rng, fake, start, stop, options):
+    count = stop - start
+    images = rng.choice(IMAGE_URLS, count)
+    headers = rng.choice(load_header_image_urls(), count)
+
+    for number, image, header in zip(range(start + 1, stop + 1),
+                                     images, headers):
+        # the number keeps usernames and emails unique at any size
+        username = f"{fake.user_name()}{number}"
+
+        yield [
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            image,
+            PASSWORD,
+            fake.sentence(),
+            header,
+            fake.city(),
+        ]
+
+
+def message_rows(rng, fake, start, stop, options):
+    count = stop - start
+    posters = weights(options.seed, 'posting', options.users,
+                      options.activity_skew)
+
+    user_ids = rng.choice(options.users, count, p=posters) + 1
+    timestamps = get_random_datetimes(rng, count, options.until,
+                                      bursts=bursts(options.seed,
+                                                    options.until),
+                                      burstiness=options.burstiness)
+
+    for user_id, timestamp in zip(user_ids, timestamps):
+        yield [fake.paragraph()[:MAX_WARBLER_LENGTH], timestamp, user_id]
+
+
+def follow_rows(rng, fake, start, stop, options):
+    """Follows by the users numbered start + 1 to stop.
+
+    Each of these users gets an even share of the --follows edges; who
+    they follow is drawn by popularity.
+    """
+
+    count = (options.follows * stop // options.users
+             - options.follows * start // options.users)
+    popularity = weights(options.seed, 'popularity', options.users,
+                         options.follower_skew)
+
+    def draw(size):
+        return (rng.integers(start + 1, stop + 1, size),
+                rng.choice(options.users, size, p=popularity) + 1)
+
+    followers, followed = sample_pairs(rng, count, draw, options.users,
+                                       same_ids=True)
+
+    for row in zip(followed, followers):
+        yield row
+
+
+def like_rows(rng, fake, start, stop, options):
+    """Likes by the users numbered start + 1 to stop.
+
+    Busy likers get more of the --likes than quiet ones, and a few
+    messages collect most of them.
+    """
+
+    likers = weights(options.seed, 'liking', options.users, options.like_skew)
+    liked = weights(options.seed, 'liked', options.messages, options.like_skew)
+
+    share = np.rint(np.cumsum(likers) * options.likes).astype(int)
+    count = share[stop - 1] - (share[start - 1] if start else 0)
+    in_range = likers[start:stop] / likers[start:stop].sum()
+
+    def draw(size):
+        return (rng.choice(stop - start, size, p=in_range) + start + 1,
+                rng.choice(options.messages, size, p=liked) + 1)
+
+    user_ids, message_ids = sample_pairs(rng, count, draw, options.messages)
+
+    for row in zip(user_ids, message_ids):
+        yield row
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, user_rows),
+    'messages': (MESSAGES_CSV_HEADERS, message_rows),
+    'follows': (FOLLOWS_CSV_HEADERS, follow_rows),
+    'likes': (LIKES_CSV_HEADERS, like_rows),
+}
+
+
+def shards(options):
+    """(table, shard number, start, stop) for every shard to write.
+
+    Users and messages are split by row; follows and likes by the user
+    making them, sized so that a shard holds about SHARD_ROWS of them on
+    average.
+    """
+
+    def users_per_shard(total):
+        return max(1, SHARD_ROWS * options.users // max(total, 1))
+
+    for table, total, size in [
+            ('users', options.users, SHARD_ROWS),
+            ('messages', options.messages, SHARD_ROWS),
+            ('follows', options.users, users_per_shard(options.follows)),
+            ('likes', options.users, users_per_shard(options.likes))]:
+        for number, start in enumerate(range(0, total, size)):
+            yield table, number, start, min(start + size, total)
+
+
+def part_path(options, table, number):
+    return os.path.join(options.out, f"{table}.csv.part{number:05d}")
+
+
+def write_shard(task):
+    """Write one shard to its part file; return (table, rows written)."""
+
+    table, number, start, stop, options = task
+    _, rows = TABLES[table]
+
+    rng = np.random.default_rng(seed_from(options.seed, table, number))
+    fake = Faker()
+    fake.seed_instance(f"{options.seed}:{table}:{number}")
+
+    written = 0
+    with open(part_path(options, table, number), 'w', newline='') as part:
+        writer = csv.writer(part)
+        for row in rows(rng, fake, start, stop, options):
+            writer.writerow(row)
+            written += 1
+
+    return table, written
+
+
+def join_parts(options, table, count):
+    """Concatenate the part files of `table` into <table>.csv."""
+
+    headers, _ = TABLES[table]
+
+    with open(os.path.join(options.out, f"{table}.csv"), 'w',
+              newline='') as out:
+        csv.writer(out).writerow(headers)
+
+        for number in range(count):
+            path = part_path(options, table, number)
+            with open(path) as part:
+                shutil.copyfileobj(part, out)
+            os.remove(path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--follower-skew', type=float, default=1.0,
+                        help="power-law exponent of follower counts")
+    parser.add_argument('--activity-skew', type=float, default=1.0,
+                        help="power-law exponent of messages per user")
+    parser.add_argument('--like-skew', type=float, default=1.0,
+                        help="power-law exponent of likes per user and "
+                             "per message")
+    parser.add_argument('--burstiness', type=float, default=0.3,
+                        help="share of messages posted in bursts")
+    parser.add_argument('--seed', default='warbler',
+                        help="same seed and sizes, same files")
+    parser.add_argument('--until', type=date.fromisoformat,
+                        default=date.today(),
+                        help="messages are dated in the two years before "
+                             "this day (default: today)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='generator')
+    options = parser.parse_args(argv)
+
+    if options.users < 2 and options.follows:
+        parser.error("follows need at least two users")
+    if options.follows > options.users * (options.users - 1):
+        parser.error("more follows than there are pairs of users")
+    if options.likes > options.users * options.messages:
+        parser.error("more likes than there are users times messages")
+
+    options.until = datetime.combine(options.until, day_start())
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    os.makedirs(options.out, exist_ok=True)
+
+    tasks = [(*shard, options) for shard in shards(options)]
+    parts = {table: 0 for table in TABLES}
+    written = {table: 0 for table in TABLES}
+    start = time.perf_counter()
+
+    with Pool(options.workers) as pool:
+        for table, count in pool.imap_unordered(write_shard, tasks):
+            parts[table] += 1
+            written[table] += count
+            elapsed = time.perf_counter() - start
+            print(f"{table}: {written[table]:,} rows "
+                  f"({sum(written.values()) / elapsed:,.0f} rows/s overall)")
+
+    for table, count in parts.items():
+        join_parts(options, table, count)
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
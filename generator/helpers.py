@@ -1,14 +1,64 @@
 """Support functions for CSV generation."""
 
+import hashlib
 from datetime import datetime
-from random import uniform
 
+import numpy as np
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+EPOCH = datetime(1970, 1, 1)
+BURST_SPREAD = 3600     # seconds; mean distance of a bursty post from its burst
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
 
-    return datetime.fromtimestamp(random_timestamp)
+def seed_from(*parts):
+    """A NumPy seed made from `parts`, the same on every run and machine."""
+
+    digest = hashlib.sha256(":".join(map(str, parts)).encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def zipf_weights(count, skew, rng):
+    """Probabilities for `count` items under a power law with exponent
+    `skew` (0 is uniform).
+
+    Ranks are dealt out to the items at random, so the most likely item is
+    not always the first one.
+    """
+
+    ranks = rng.permutation(count) + 1
+    weights = ranks.astype(float) ** -skew
+    return weights / weights.sum()
+
+
+def get_random_datetimes(rng, count, now, year_gap=2, bursts=None,
+                         burstiness=0):
+    """Get `count` random datetimes within the last few years, as strings.
+
+    A `burstiness` share of them falls just after one of `bursts`, a
+    (times, weights) pair of epoch seconds and probabilities as made by
+    get_bursts(); the rest are spread evenly.
+    """
+
+    end = (now - EPOCH).total_seconds()
+    start = (now.replace(year=now.year - year_gap) - EPOCH).total_seconds()
+
+    seconds = rng.uniform(start, end, count)
+
+    if bursts is not None and burstiness:
+        times, weights = bursts
+        bursty = rng.random(count) < burstiness
+        chosen = rng.choice(len(times), size=bursty.sum(), p=weights)
+        seconds[bursty] = np.minimum(
+            times[chosen] + rng.exponential(BURST_SPREAD, bursty.sum()), end)
+
+    stamps = np.datetime_as_string((seconds * 1e6).astype('datetime64[us]'))
+    return np.char.replace(stamps, 'T', ' ')
+
+
+def get_bursts(rng, count, now, year_gap=2, skew=1.0):
+    """`count` burst times within the last few years, with power-law
+    weights: a handful of big events and many small ones."""
+
+    end = (now - EPOCH).total_seconds()
+    start = (now.replace(year=now.year - year_gap) - EPOCH).total_seconds()
+
+    return rng.uniform(start, end, count), zipf_weights(count, skew, rng)
@@ -0,0 +1,307 @@
+"""Request metrics for Warbler, served at /metrics in Prometheus text format.
+
+Recorded per process in a thread-safe Registry:
+
+    warbler_requests_total                    by endpoint, method, status
+    warbler_request_duration_seconds          histogram by endpoint
+    warbler_response_size_bytes               histogram by endpoint
+    warbler_requests_in_flight                gauge
+    warbler_startup_seconds                   gauge; cold start of the app
+    warbler_db_pool_checkout_seconds          histogram; time waiting for
+                                              a pooled connection
+    warbler_password_hash_seconds             histogram by operation
+                                              (hash, check)
+
+With several worker processes (e.g. a pre-forking server), set METRICS_DIR
+to a directory they share. Every process then writes its values there at
+most every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the files
+of all of them. Counters of workers that have exited still count; their
+gauges do not. Gauges of live workers are added up, so the startup gauge
+is the total over workers. Files are named by process id and start time,
+so a new worker that is given an old worker's pid is not taken for it.
+
+Request durations stop when the view returns, so the time spent sending a
+streamed body is not included.
+"""
+
+import json
+import os
+import threading
+import time
+
+from flask import current_app, g, request
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1000, 5000, 20000, 50000, 100000, 500000, 1000000, 5000000)
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class Registry:
+    """Counters, gauges and histograms, keyed by name and labels."""
+
+    def __init__(self):
+        self._definitions = {}      # name -> (kind, help, buckets)
+        self._values = {}           # (name, labels) -> float or list
+        self._lock = threading.Lock()
+
+    def define(self, name, kind, help, buckets=None):
+        self._definitions[name] = (kind, help, buckets)
+
+    def kind(self, name):
+        return self._definitions[name][0]
+
+    def inc(self, name, amount=1, **labels):
+        """Add `amount` to a counter or gauge."""
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """Set a gauge to `value`."""
+
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        """Record `value` in a histogram."""
+
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._definitions[name][2]
+
+        with self._lock:
+            # a count per bucket (the last is +Inf), then the sum
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(buckets)
+
+            counts[i] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        """All values as JSON-friendly [name, labels, value] triples."""
+
+        with self._lock:
+            return [[name, list(map(list, labels)),
+                     list(value) if isinstance(value, list) else value]
+                    for (name, labels), value in self._values.items()]
+
+    def render(self, snapshots):
+        """Prometheus text for the sum of `snapshots`, as returned by
+        snapshot() (or read back from METRICS_DIR)."""
+
+        totals = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot:
+                key = (name, tuple(map(tuple, labels)))
+                if isinstance(value, list):
+                    total = totals.setdefault(key, [0] * len(value))
+                    for i, part in enumerate(value):
+                        total[i] += part
+                else:
+                    totals[key] = totals.get(key, 0) + value
+
+        lines = []
+
+        for name, (kind, help, buckets) in sorted(self._definitions.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for (metric, labels), value in sorted(totals.items()):
+                if metric != name:
+                    continue
+
+                if kind != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket"
+                                 f"{format_labels(labels + (('le', bound),))}"
+                                 f" {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{format_labels(labels)} "
+                             f"{cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"')
+               for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"'
+                          for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def process_started(pid):
+    """When process `pid` started, in clock ticks since boot (from /proc);
+    0 where that can't be told."""
+
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # fields after the command name, which may itself hold spaces
+            return int(stat.read().rpartition(')')[2].split()[19])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def process_alive(pid, started=0):
+    """Whether `pid` is running and, if `started` is known, is still the
+    process that started then."""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    now = process_started(pid)
+    return not (started and now) or now == started
+
+
+class Metrics:
+    """The app's Registry, the hooks that feed it and the /metrics page."""
+
+    def __init__(self):
+        self.registry = Registry()
+        self._next_flush = 0
+
+        for name, kind, help, buckets in [
+            ('warbler_requests_total', 'counter',
+             "Requests handled.", None),
+            ('warbler_request_duration_seconds', 'histogram',
+             "Time to handle a request.", LATENCY_BUCKETS),
+            ('warbler_response_size_bytes', 'histogram',
+             "Size of response bodies.", SIZE_BUCKETS),
+            ('warbler_requests_in_flight', 'gauge',
+             "Requests being handled.", None),
+            ('warbler_startup_seconds', 'gauge',
+             "Time create_app() took to build the app.", None),
+            ('warbler_db_pool_checkout_seconds', 'histogram',
+             "Time spent waiting for a database connection.",
+             LATENCY_BUCKETS),
+            ('warbler_password_hash_seconds', 'histogram',
+             "Time to hash or check a password, queueing included.",
+             LATENCY_BUCKETS),
+        ]:
+            self.registry.define(name, kind, help, buckets)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+
+        app.before_request(self._start_request)
+        app.after_request(self._record_response)
+        app.teardown_request(self._finish_request)
+
+    def inc(self, name, amount=1, **labels):
+        self.registry.inc(name, amount, **labels)
+
+    def set(self, name, value, **labels):
+        self.registry.set(name, value, **labels)
+
+    def observe(self, name, value, **labels):
+        self.registry.observe(name, value, **labels)
+
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+        self.inc('warbler_requests_in_flight')
+
+    def _record_response(self, response):
+        endpoint = request.endpoint or 'unknown'
+
+        self.inc('warbler_requests_total', endpoint=endpoint,
+                 method=request.method, status=response.status_code)
+        self.observe('warbler_request_duration_seconds',
+                     time.perf_counter() - g.metrics_start, endpoint=endpoint)
+
+        # streamed responses have no length up front
+        if response.content_length is not None:
+            self.observe('warbler_response_size_bytes',
+                         response.content_length, endpoint=endpoint)
+
+        return response
+
+    def _finish_request(self, exc):
+        if g.pop('metrics_start', None) is not None:
+            self.inc('warbler_requests_in_flight', -1)
+            self.flush()
+
+    def flush(self, force=False):
+        """Write this process's values to METRICS_DIR, at most every
+        METRICS_FLUSH_INTERVAL seconds unless `force`d."""
+
+        directory = current_app.config['METRICS_DIR']
+        now = time.monotonic()
+
+        if not directory or (now < self._next_flush and not force):
+            return
+
+        self._next_flush = now + current_app.config['METRICS_FLUSH_INTERVAL']
+
+        pid = os.getpid()
+        path = os.path.join(directory, f"{pid}-{process_started(pid)}.json")
+        with open(path + '.tmp', 'w') as out:
+            json.dump(self.registry.snapshot(), out)
+        os.replace(path + '.tmp', path)
+
+    def render(self):
+        """The /metrics page: this process, or every process in METRICS_DIR."""
+
+        directory = current_app.config['METRICS_DIR']
+
+        if not directory:
+            return self.registry.render([self.registry.snapshot()])
+
+        self.flush(force=True)
+        snapshots = []
+
+        for filename in os.listdir(directory):
+            name, extension = os.path.splitext(filename)
+            pid, _, started = name.partition('-')
+            if not (extension == '.json' and pid.isdigit()
+                    and started.isdigit()):
+                continue
+
+            try:
+                with open(os.path.join(directory, filename)) as data:
+                    snapshot = json.load(data)
+            except (OSError, ValueError):
+                continue        # removed or half-written meanwhile
+
+            if not process_alive(int(pid), int(started)):
+                snapshot = [entry for entry in snapshot
+                            if self.registry.kind(entry[0]) != 'gauge']
+            snapshots.append(snapshot)
+
+        return self.registry.render(snapshots)
+
+
+metrics = Metrics()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe('warbler_db_pool_checkout_seconds',
+                            time.perf_counter() - start)
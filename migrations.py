@@ -0,0 +1,247 @@
+"""Versioned schema migrations for Warbler.
+
+`db.create_all()` only builds a schema from scratch (see seed.py). Databases
+that already hold data are brought up to date by the numbered migrations
+below, each applied once and recorded in the `schema_migrations` table.
+
+Run from the project root:
+
+    python migrations.py status     # list migrations and whether applied
+    python migrations.py upgrade    # apply everything pending
+    python migrations.py stamp      # mark all as applied (fresh create_all)
+
+On PostgreSQL, indexes are built with CREATE INDEX CONCURRENTLY so that
+upgrading a live database does not block writes.
+"""
+
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, Text
+
+from bulkload import deferred_constraints, renumber_messages
+from models import db, pg_trgm_available, TimelineEntry, User
+
+Migration = namedtuple('Migration', ['version', 'description', 'run'])
+
+MIGRATIONS = []
+
+# Kept out of db.metadata so drop_all()/create_all() leave the history alone.
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def migration(version, description):
+    """Register the decorated function as migration number `version`.
+
+    The function is called with the engine and is responsible for its own
+    transactions (concurrent index builds cannot run inside one).
+    """
+
+    def register(run):
+        MIGRATIONS.append(Migration(version, description, run))
+        MIGRATIONS.sort()
+        return run
+
+    return register
+
+
+def create_index(engine, name, table, columns, using=None, unique=False):
+    """Create an index without blocking writes to `table` (on PostgreSQL).
+
+    A failed concurrent build leaves an INVALID index behind, which
+    IF NOT EXISTS would then happily skip, so those are dropped first.
+    """
+
+    using = f"USING {using} " if using else ""
+    unique = "UNIQUE " if unique else ""
+
+    if engine.dialect.name != 'postgresql':
+        engine.execute(
+            f"CREATE {unique}INDEX IF NOT EXISTS {name} "
+            f"ON {table} {using}({columns})")
+        return
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+
+        invalid = conn.execute(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = indexrelid "
+            "WHERE relname = %s AND NOT indisvalid", (name,)).scalar()
+        if invalid:
+            conn.execute(f"DROP INDEX CONCURRENTLY {name}")
+
+        conn.execute(f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                     f"ON {table} {using}({columns})")
+
+
+##############################################################################
+# Migrations, oldest first. Never edit one that has shipped; add a new one.
+
+
+@migration(1, "materialized home timelines")
+def create_timelines(engine):
+    from timelines import rebuild_timelines
+
+    TimelineEntry.__table__.create(engine, checkfirst=True)
+    rebuild_timelines()
+    db.session.commit()
+
+
+@migration(2, "secondary indexes for timeline, profile, likes and follows")
+def add_secondary_indexes(engine):
+    create_index(engine, 'ix_messages_user_id_timestamp',
+                 'messages', 'user_id, timestamp, id')
+    create_index(engine, 'ix_likes_user_id', 'likes', 'user_id, message_id')
+    create_index(engine, 'ix_follows_user_following_id',
+                 'follows', 'user_following_id, user_being_followed_id')
+
+    if (engine.dialect.name == 'postgresql'
+            and pg_trgm_available(None, None, engine)):
+        engine.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        create_index(engine, 'ix_users_username_trgm',
+                     'users', 'username gin_trgm_ops', using='gin')
+
+
+@migration(3, "denormalized per-user counters")
+def add_user_counters(engine):
+    with engine.begin() as conn:
+        for column in ['message_count', 'following_count',
+                       'follower_count', 'like_count']:
+            conn.execute(f"ALTER TABLE users ADD COLUMN IF NOT EXISTS "
+                         f"{column} INTEGER NOT NULL DEFAULT 0")
+
+    User.reconcile_counters()
+    db.session.commit()
+
+    create_index(engine, 'ix_users_follower_count', 'users', 'follower_count')
+
+
+@migration(4, "likes unique per (user, message) instead of per message")
+def likes_unique_per_user(engine):
+    create_index(engine, 'uq_likes_user_id_message_id',
+                 'likes', 'user_id, message_id', unique=True)
+    create_index(engine, 'ix_likes_message_id', 'likes', 'message_id')
+
+    with engine.begin() as conn:
+        conn.execute("ALTER TABLE likes DROP CONSTRAINT IF EXISTS "
+                     "likes_message_id_key")
+        conn.execute("ALTER TABLE likes ADD CONSTRAINT "
+                     "uq_likes_user_id_message_id UNIQUE USING INDEX "
+                     "uq_likes_user_id_message_id")
+
+    engine.execute("DROP INDEX IF EXISTS ix_likes_user_id")
+
+
+@migration(5, "case-insensitive username prefix index")
+def add_username_prefix_index(engine):
+    create_index(engine, 'ix_users_username_prefix',
+                 'users', '(lower(username) COLLATE "C")')
+
+
+@migration(6, "full-text search over message text")
+def add_message_search(engine):
+    # adding a stored generated column rewrites the table (and holds an
+    # exclusive lock while doing so); schedule this for a quiet period
+    with engine.begin() as conn:
+        conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS "
+                     "search_vector tsvector GENERATED ALWAYS AS "
+                     "(to_tsvector('english', text)) STORED")
+
+    create_index(engine, 'ix_messages_search_vector',
+                 'messages', 'search_vector', using='gin')
+
+
+@migration(7, "time-ordered message ids")
+def time_ordered_message_ids(engine):
+    # rewrites messages, likes and timelines and holds exclusive locks on
+    # them meanwhile; schedule this for a quiet period. All in one
+    # transaction, so a failure leaves the schema as it was.
+    with engine.begin() as conn:
+        conn.execute("DROP INDEX IF EXISTS ix_messages_user_id_timestamp")
+        conn.execute("DROP INDEX IF EXISTS ix_timelines_user_id_timestamp")
+
+        with deferred_constraints(conn, ['messages', 'likes', 'timelines']):
+            if conn.dialect.name == 'postgresql':
+                conn.execute("ALTER TABLE messages "
+                             "ALTER COLUMN id DROP DEFAULT, "
+                             "ALTER COLUMN id TYPE bigint")
+                conn.execute("DROP SEQUENCE IF EXISTS messages_id_seq")
+                for table in ['likes', 'timelines']:
+                    conn.execute(f"ALTER TABLE {table} "
+                                 f"ALTER COLUMN message_id TYPE bigint")
+
+            renumber_messages(conn)
+
+    create_index(engine, 'ix_messages_user_id_id', 'messages', 'user_id, id')
+
+
+##############################################################################
+# Runner
+
+
+def applied_versions(engine):
+    """Versions already recorded in `schema_migrations`."""
+
+    schema_migrations.create(engine, checkfirst=True)
+    return {row.version
+            for row in engine.execute(schema_migrations.select())}
+
+
+def record(engine, mig):
+    engine.execute(schema_migrations.insert(),
+                   version=mig.version,
+                   description=mig.description,
+                   applied_at=datetime.utcnow())
+
+
+def upgrade(target=None):
+    """Apply every pending migration up to `target` (default: all)."""
+
+    engine = db.engine
+    done = applied_versions(engine)
+
+    for mig in MIGRATIONS:
+        if mig.version in done or (target and mig.version > target):
+            continue
+
+        print(f"Applying {mig.version:04d}: {mig.description}")
+        mig.run(engine)
+        record(engine, mig)
+
+
+def stamp():
+    """Mark all migrations applied; for schemas built by create_all()."""
+
+    engine = db.engine
+    done = applied_versions(engine)
+
+    for mig in MIGRATIONS:
+        if mig.version not in done:
+            record(engine, mig)
+
+
+def status():
+    done = applied_versions(db.engine)
+
+    for mig in MIGRATIONS:
+        state = "applied" if mig.version in done else "pending"
+        print(f"{mig.version:04d}  {state:<8} {mig.description}")
+
+
+if __name__ == '__main__':
+    from app import app
+
+    commands = {'upgrade': upgrade, 'stamp': stamp, 'status': status}
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+
+    if command not in commands:
+        sys.exit(f"usage: python migrations.py [{'|'.join(commands)}]")
+
+    with app.app_context():
+        commands[command]()
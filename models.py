@@ -1,11 +1,20 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import os
+from collections import Counter
+from contextlib import closing
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, func, literal, select
+from sqlalchemy.dialects.postgresql import insert, TSVECTOR
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm.util import identity_key
+
+from changes import (record, UserChanged, MessageChanged, FollowChanged,
+                     LikeChanged)
+from passwords import hash_password, check_password, needs_rehash
+from snowflake import MAX_WORKER, message_ids, timestamp_of
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
@@ -26,6 +35,11 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -43,9 +57,14 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_id_message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
 
@@ -95,25 +114,63 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts for the stats bar; kept up to date by
+    # update_counters() below and repaired by reconcile_counters.py.
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+        index=True,
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    messages = db.relationship('Message', passive_deletes=True)
+
+    # read-only: writes go through follow()/unfollow() and the like
+    # helpers, so the counters and the change bus see them
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        viewonly=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        viewonly=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        viewonly=True,
     )
 
     def __repr__(self):
@@ -122,14 +179,95 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.follow_states([other_user.id])[1]
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.follow_states([other_user.id])[0]
+
+    def follow(self, user_ids):
+        """Start following each of `user_ids`; returns the newly followed.
+
+        A single INSERT ... ON CONFLICT DO NOTHING: ids already followed,
+        unknown ids and this user's own id are skipped, so calling it
+        again is harmless.
+        """
+
+        users = User.__table__
+        user_ids = list(user_ids)
+
+        if not user_ids:
+            return set()
+
+        rows = db.session.execute(
+            insert(Follows.__table__)
+            .from_select(['user_being_followed_id', 'user_following_id'],
+                         select([users.c.id, literal(self.id)])
+                         .where(users.c.id.in_(user_ids))
+                         .where(users.c.id != self.id))
+            .on_conflict_do_nothing()
+            .returning(Follows.user_being_followed_id))
+
+        followed = {row[0] for row in rows}
+
+        record(db.session, *(FollowChanged(self.id, followed_id, False)
+                             for followed_id in followed))
+        adjust_counter(db.session, self.id, 'following_count', len(followed))
+        adjust_counters(db.session, followed, 'follower_count', 1)
+        return followed
+
+    def unfollow(self, user_id):
+        """Stop following `user_id`; returns whether a follow was removed."""
+
+        removed = (Follows
+                   .query
+                   .filter_by(user_being_followed_id=user_id,
+                              user_following_id=self.id)
+                   .delete(synchronize_session=False))
+
+        if removed:
+            record(db.session, FollowChanged(self.id, user_id, True))
+            adjust_counter(db.session, self.id, 'following_count', -1)
+            adjust_counter(db.session, user_id, 'follower_count', -1)
+
+        return bool(removed)
+
+    def following_ids(self):
+        """Set of ids of everyone this user follows (one query)."""
+
+        return {row[0] for row in (db.session
+                                   .query(Follows.user_being_followed_id)
+                                   .filter(Follows.user_following_id == self.id))}
+
+    def follow_states(self, user_ids):
+        """Which of `user_ids` this user follows, and which follow this user.
+
+        Answers both in one query; returns (following, followed_by) sets.
+        """
+
+        user_ids = list(user_ids)
+        following, followed_by = set(), set()
+
+        if not user_ids:
+            return following, followed_by
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id,
+                       Follows.user_following_id)
+                .filter(db.or_(
+                    db.and_(Follows.user_following_id == self.id,
+                            Follows.user_being_followed_id.in_(user_ids)),
+                    db.and_(Follows.user_being_followed_id == self.id,
+                            Follows.user_following_id.in_(user_ids)))))
+
+        for followed_id, follower_id in rows:
+            if follower_id == self.id:
+                following.add(followed_id)
+            if followed_id == self.id:
+                followed_by.add(follower_id)
+
+        return following, followed_by
 
     def edit_user(self, username, email, image_url, header_image_url, bio):
         self.username = username
@@ -140,13 +278,121 @@ class User(db.Model):
         db.session.commit()
 
     def add_like(self, msg):
-        self.likes.append(msg)
+        db.session.add(Likes(user_id=self.id, message_id=msg.id))
         db.session.commit()
 
     def remove_like(self, msg):
-        self.likes.remove(msg)
+        removed = (Likes
+                   .query
+                   .filter_by(user_id=self.id, message_id=msg.id)
+                   .delete(synchronize_session=False))
+        if removed:
+            record(db.session, LikeChanged(self.id, msg.id, True))
+            adjust_counter(db.session, self.id, 'like_count', -removed)
         db.session.commit()
 
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` this user has liked, as a set."""
+
+        message_ids = list(message_ids)
+
+        if not message_ids:
+            return set()
+
+        return {row[0] for row in (db.session
+                                   .query(Likes.message_id)
+                                   .filter(Likes.user_id == self.id,
+                                           Likes.message_id.in_(message_ids)))}
+
+    def toggle_like(self, msg):
+        """Like `msg` if not yet liked, otherwise unlike it.
+
+        One statement: delete the like if it exists, else insert it.
+        Returns True if the message is now liked. If a concurrent toggle
+        inserted the like first, it stays liked and nothing is counted.
+        """
+
+        liked, unliked = db.session.execute(TOGGLE_LIKE, {
+            'user_id': self.id,
+            'message_id': msg.id,
+        }).first()
+
+        if liked or unliked:
+            record(db.session, LikeChanged(self.id, msg.id, bool(unliked)))
+            adjust_counter(db.session, self.id, 'like_count',
+                           1 if liked else -1)
+
+        return not unliked
+
+    def remove_from_counters(self):
+        """Take this user's follows and likes out of other users' counts.
+
+        Call before deleting the user: the database cascades the deletes,
+        so the flush hooks never see those rows go. Every user whose
+        counts change is recorded as a UserChanged. Returns the ids of the
+        users who lost a follower.
+        """
+
+        users = User.__table__
+
+        liked = (select([Likes.user_id, func.count().label('n')])
+                 .select_from(Likes.__table__.join(Message.__table__))
+                 .where(Message.user_id == self.id)
+                 .where(Likes.user_id != self.id)
+                 .group_by(Likes.user_id)
+                 .alias('liked'))
+
+        updates = [
+            (users.update()
+             .where(users.c.id.in_(
+                 select([Follows.user_being_followed_id])
+                 .where(Follows.user_following_id == self.id)))
+             .values(follower_count=users.c.follower_count - 1),
+             'follower_count'),
+            (users.update()
+             .where(users.c.id.in_(
+                 select([Follows.user_following_id])
+                 .where(Follows.user_being_followed_id == self.id)))
+             .values(following_count=users.c.following_count - 1),
+             'following_count'),
+            (users.update()
+             .where(users.c.id == liked.c.user_id)
+             .values(like_count=users.c.like_count - liked.c.n),
+             'like_count'),
+        ]
+
+        changed, unfollowed = set(), []
+        for update, column in updates:
+            for user_id, in db.session.execute(update.returning(users.c.id)):
+                changed.add(user_id)
+                if column == 'follower_count':
+                    unfollowed.append(user_id)
+
+                user = db.session.identity_map.get(identity_key(User, user_id))
+                if user is not None:
+                    db.session.expire(user, [column])
+
+        record(db.session, *(UserChanged(user_id, None, False)
+                             for user_id in sorted(changed)))
+
+        return unfollowed
+
+    @classmethod
+    def reconcile_counters(cls):
+        """Recompute every user's counters from the source tables."""
+
+        users = cls.__table__
+
+        def count(key):
+            return select([func.count()]).where(key == users.c.id).as_scalar()
+
+        db.session.execute(users.update().values(
+            message_count=count(Message.user_id),
+            following_count=count(Follows.user_following_id),
+            follower_count=count(Follows.user_being_followed_id),
+            like_count=count(Likes.user_id),
+        ))
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -154,7 +400,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(db.get_app(), password)
 
         user = User(
             username=username,
@@ -175,13 +421,20 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with a different work factor than
+        BCRYPT_LOG_ROUNDS, it is transparently replaced.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            app = db.get_app()
+            is_auth = check_password(app, user.password, password)
             if is_auth:
+                if needs_rehash(app, user.password):
+                    user.password = hash_password(app, password)
+                    db.session.commit()
                 return user
 
         return False
@@ -192,9 +445,11 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # time-ordered, made in process (see snowflake.py)
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
     )
 
     text = db.Column(
@@ -202,10 +457,10 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # when the message was posted; always timestamp_of(id) for new ones
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
     )
 
     user_id = db.Column(
@@ -214,8 +469,272 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # maintained by PostgreSQL on every insert/update; for message search.
+    # On SQLite (bulkload.py's fallback) it is a plain, empty text column.
+    search_vector = db.deferred(db.Column(
+        TSVECTOR().with_variant(db.Text, 'sqlite'),
+        db.Computed("to_tsvector('english', text)", persisted=True),
+    ))
+
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+        db.Index('ix_messages_search_vector', 'search_vector',
+                 postgresql_using='gin'),
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        if self.id is None:
+            self.id = message_ids.next_id()
+        if self.timestamp is None:
+            self.timestamp = timestamp_of(self.id)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline."""
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # message ids are time-ordered, so the primary key (user_id,
+    # message_id) also reads a timeline in order
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+##############################################################################
+# Counter maintenance
+
+# (model, counter column, attribute holding the counted user's id)
+COUNTED = {
+    Message: [('message_count', 'user_id')],
+    Follows: [('follower_count', 'user_being_followed_id'),
+              ('following_count', 'user_following_id')],
+    Likes: [('like_count', 'user_id')],
+}
+
+
+# (liked, unliked): 1 for the row inserted or deleted; both are 0 when
+# the insert lost a race with another toggle inserting the same like
+TOGGLE_LIKE = db.text("""
+    WITH unliked AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING id
+    ), liked AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, :message_id
+        WHERE NOT EXISTS (SELECT 1 FROM unliked)
+        ON CONFLICT (user_id, message_id) DO NOTHING
+        RETURNING id
+    )
+    SELECT (SELECT count(*) FROM liked), (SELECT count(*) FROM unliked)
+""")
+
+
+def adjust_counter(session, user_id, column, delta):
+    """Add `delta` to one counter column of `user_id`."""
+
+    adjust_counters(session, [user_id], column, delta)
+
+
+def adjust_counters(session, user_ids, column, delta):
+    """Add `delta` to one counter column of each of `user_ids`."""
+
+    users = User.__table__
+    user_ids = list(user_ids)
+
+    if not user_ids:
+        return
+
+    session.execute(users.update()
+                    .where(users.c.id.in_(user_ids))
+                    .values({column: users.c[column] + delta}))
+    record(session, *(UserChanged(user_id, None, False)
+                      for user_id in user_ids))
+
+    for user_id in user_ids:
+        user = session.identity_map.get(identity_key(User, user_id))
+        if user is not None:
+            session.expire(user, [column])
+
+
+@event.listens_for(db.session, 'before_flush')
+def release_likes_of_deleted_messages(session, flush_context, instances):
+    """Discount likes of messages being deleted (the database cascades them)."""
+
+    message_ids = [obj.id for obj in session.deleted
+                   if isinstance(obj, Message)]
+
+    if not message_ids:
+        return
+
+    likers = (session
+              .query(Likes.user_id, func.count())
+              .filter(Likes.message_id.in_(message_ids))
+              .group_by(Likes.user_id))
+
+    for user_id, n in likers.all():
+        adjust_counter(session, user_id, 'like_count', -n)
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_counters(session, flush_context):
+    """Apply counter changes for messages, follows and likes just flushed."""
+
+    deltas = Counter()
+
+    for objects, sign in [(session.new, 1), (session.deleted, -1)]:
+        for obj in objects:
+            for column, attr in COUNTED.get(type(obj), []):
+                deltas[getattr(obj, attr), column] += sign
+
+    for (user_id, column), delta in deltas.items():
+        if delta:
+            adjust_counter(session, user_id, column, delta)
+
+
+def change_of(obj, deleted):
+    """The change event for a flushed row, or None."""
+
+    if isinstance(obj, User):
+        return UserChanged(obj.id, obj.username, deleted)
+    if isinstance(obj, Message):
+        return MessageChanged(obj.id, obj.user_id, deleted)
+    if isinstance(obj, Follows):
+        return FollowChanged(obj.user_following_id, obj.user_being_followed_id,
+                             deleted)
+    if isinstance(obj, Likes):
+        return LikeChanged(obj.user_id, obj.message_id, deleted)
+    return None
+
+
+@event.listens_for(db.session, 'after_flush')
+def record_flush_changes(session, flush_context):
+    """Record change events for the rows just flushed (see changes.py)."""
+
+    flushed = ([(obj, False) for obj in session.new]
+               + [(obj, False) for obj in session.dirty
+                  if session.is_modified(obj)]
+               + [(obj, True) for obj in session.deleted])
+
+    record(session, *filter(None, (change_of(obj, deleted)
+                                   for obj, deleted in flushed)))
+
+
+def pg_trgm_available(ddl, target, bind, **kw):
+    """Can the pg_trgm extension be installed on this PostgreSQL server?"""
+
+    return bind.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ).scalar() is not None
+
+
+# Username search uses LIKE '%...%', which only a trigram index can serve.
+# It needs an extension, so it is created outside of the declared indexes.
+
+USERNAME_TRGM_INDEX = DDL(
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (username gin_trgm_ops)"
+)
+
+event.listen(
+    User.__table__,
+    'after_create',
+    USERNAME_TRGM_INDEX.execute_if(dialect='postgresql',
+                                   callable_=pg_trgm_available),
+)
+
+
+# Prefix search needs lower(username) with a byte-wise collation: then
+# LIKE 'ab%' is a plain range scan and the matches come out in order.
+
+USERNAME_PREFIX_INDEX = DDL(
+    'CREATE INDEX IF NOT EXISTS ix_users_username_prefix '
+    'ON users ((lower(username) COLLATE "C"))'
+)
+
+event.listen(
+    User.__table__,
+    'after_create',
+    USERNAME_PREFIX_INDEX.execute_if(dialect='postgresql'),
+)
+
+
+@compiles(db.Computed, 'sqlite')
+def skip_computed_on_sqlite(computed, compiler, **kw):
+    """SQLite has no to_tsvector(); leave generated columns out there."""
+
+    return ''
+
+
+##############################################################################
+# Message id workers
+
+# Advisory lock key space for worker numbers (any constant of our own).
+WORKER_LOCK_CLASS = 0x5742
+
+# The connections holding our claims, kept open for the life of the
+# process. A forked child keeps its parent's too: closing an inherited
+# connection would end the parent's session, and with it the claim.
+_worker_connections = []
+
+
+def claim_worker_number():
+    """A message id worker number no other live process holds, or None.
+
+    Claimed as a PostgreSQL advisory lock on a connection taken out of the
+    pool, so it is given back when the process exits, however it exits.
+    Other databases (and a database with every number held) get None, and
+    the generator falls back to the process id (see snowflake.py).
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        return None
+
+    connection = db.engine.raw_connection()
+    connection.detach()
+    connection.connection.autocommit = True
+
+    start = os.getpid() & MAX_WORKER
+    with closing(connection.cursor()) as cursor:
+        for offset in range(MAX_WORKER + 1):
+            number = (start + offset) & MAX_WORKER
+            cursor.execute("SELECT pg_try_advisory_lock(%s, %s)",
+                           (WORKER_LOCK_CLASS, number))
+            if cursor.fetchone()[0]:
+                _worker_connections.append(connection)
+                return number
+
+    connection.close()
+    return None
+
+
+message_ids.claim = claim_worker_number
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
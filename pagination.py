@@ -0,0 +1,127 @@
+"""Keyset (cursor) pagination for Warbler.
+
+Pages are selected by an opaque cursor naming the key of the row at the
+edge of the previous page, so every page is a bounded index range read no
+matter how deep someone scrolls. Messages are keyed by their id alone,
+which is time-ordered (see snowflake.py). Ranked lists (search results) use
+a (lo, hi, score, id) cursor the same way, and alphabetical lists a
+(name, id) one.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+
+Page = namedtuple('Page', ['items', 'older', 'newer'])
+
+
+class InvalidCursor(ValueError):
+    """A cursor token from the query string could not be decoded."""
+
+
+def encode_cursor(*key):
+    """Make an opaque, URL-safe token for a key such as (id,) or
+    (timestamp, id).
+
+    The parts before the id may be ints, float scores, datetimes or
+    strings; a string may only come last before the id.
+    """
+
+    *parts, id = key
+    raw = [str(id)]
+
+    for part in reversed(parts):
+        if isinstance(part, datetime):
+            part = part.isoformat()
+        elif isinstance(part, str):
+            part = "'" + part
+        raw.insert(0, str(part))
+
+    raw = '|'.join(raw)
+
+    return urlsafe_b64encode(raw.encode('UTF-8')).decode('ascii').rstrip('=')
+
+
+def _decode_part(text):
+    if text.startswith("'"):
+        return text[1:]
+    if ':' in text:
+        return datetime.fromisoformat(text)
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def decode_cursor(token, types=None):
+    """Turn a token from `encode_cursor` back into its key.
+
+    With `types`, the key must have one part of each type in order (an
+    int will do for a float), or InvalidCursor is raised.
+    """
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = urlsafe_b64decode(padded.encode('ascii')).decode('UTF-8')
+
+        head, _, id = raw.rpartition('|')
+        key = [int(id)]
+
+        # a string runs to the id, so it may itself contain '|'
+        while head:
+            if head.startswith("'"):
+                part, head = head, ''
+            else:
+                part, _, head = head.partition('|')
+            key.insert(len(key) - 1, _decode_part(part))
+
+    except (ValueError, UnicodeError) as exc:
+        raise InvalidCursor(token) from exc
+
+    if types is not None and not (
+            len(key) == len(types)
+            and all(isinstance(part, (int, float) if expected is float
+                               else expected)
+                    for part, expected in zip(key, types))):
+        raise InvalidCursor(token)
+
+    return tuple(key)
+
+
+def message_key(msg):
+    """Sort key of a message: the tuple cursors are built from."""
+
+    return (msg.id,)
+
+
+MESSAGE_KEY_TYPES = (int,)
+
+
+def keyset_page(fetch, per_page, before=None, after=None, key=message_key,
+                types=MESSAGE_KEY_TYPES):
+    """Fetch one page of rows around the `before`/`after` cursor tokens.
+
+    `fetch(limit, before, after)` gets decoded cursors and must return rows
+    in scan order: newest first when paging older (or from the top), oldest
+    first when paging newer. One extra row is requested to tell whether
+    there is anything beyond this page. `types` are the types of the parts
+    of `key`; a cursor that does not match them is an InvalidCursor.
+    """
+
+    before = decode_cursor(before, types) if before else None
+    after = decode_cursor(after, types) if after else None
+
+    rows = fetch(per_page + 1, before, after)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if after:
+        rows.reverse()
+        has_older, has_newer = True, has_more
+    else:
+        has_older, has_newer = has_more, before is not None
+
+    older = encode_cursor(*key(rows[-1])) if rows and has_older else None
+    newer = encode_cursor(*key(rows[0])) if rows and has_newer else None
+
+    return Page(rows, older, newer)
@@ -0,0 +1,147 @@
+"""Password hashing for Warbler, off the request thread.
+
+bcrypt is deliberately slow; run inline, a burst of logins pins every web
+worker's CPU and starves unrelated routes. Hashes are instead computed in a
+small process pool with a bounded number of outstanding jobs. When the pool
+is saturated we fail fast with PasswordHasherBusy rather than queueing, and
+so we do when a result takes longer than PASSWORD_HASH_TIMEOUT. A job we
+stopped waiting for keeps its slot until it finishes.
+
+Settings (app.config):
+
+    BCRYPT_LOG_ROUNDS      work factor for new hashes (default 12)
+    PASSWORD_HASH_WORKERS  pool processes; 0 hashes inline (default 2)
+    PASSWORD_HASH_QUEUE    max jobs running or waiting (default 8)
+    PASSWORD_HASH_TIMEOUT  seconds to wait for a result (default 10)
+"""
+
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+from metrics import metrics
+
+DEFAULT_LOG_ROUNDS = 12
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already in flight."""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher:
+    """Runs bcrypt in a bounded process pool."""
+
+    def __init__(self, workers=2, queue_limit=8, timeout=10):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(queue_limit, 1))
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def run(self, fn, *args):
+        """Run `fn(*args)` in the pool, or raise PasswordHasherBusy."""
+
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        if not self.workers:
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+
+        try:
+            future = self.pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        # the slot is the job's, not ours: held until the pool is done
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordHasherBusy() from None
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def get_hasher(app):
+    """The PasswordHasher for `app`, created on first use."""
+
+    hasher = app.extensions.get('password_hasher')
+
+    if hasher is None:
+        hasher = PasswordHasher(
+            workers=app.config.get('PASSWORD_HASH_WORKERS', 2),
+            queue_limit=app.config.get('PASSWORD_HASH_QUEUE', 8),
+            timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 10),
+        )
+        app.extensions['password_hasher'] = hasher
+
+    return hasher
+
+
+def log_rounds(app):
+    return app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+
+def hash_password(app, password):
+    """bcrypt hash of `password` at `app`'s configured work factor."""
+
+    if not password:
+        raise ValueError('Password must be non-empty.')
+
+    start = time.perf_counter()
+    hashed = get_hasher(app).run(_hash, password.encode('UTF-8'),
+                                 log_rounds(app))
+    metrics.observe('warbler_password_hash_seconds',
+                    time.perf_counter() - start, operation='hash')
+
+    return hashed.decode('UTF-8')
+
+
+def check_password(app, hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    if not password:
+        return False
+
+    start = time.perf_counter()
+    matches = get_hasher(app).run(_check, hashed.encode('UTF-8'),
+                                  password.encode('UTF-8'))
+    metrics.observe('warbler_password_hash_seconds',
+                    time.perf_counter() - start, operation='check')
+
+    return matches
+
+
+def needs_rehash(app, hashed):
+    """Was `hashed` made with a different work factor than configured?"""
+
+    try:
+        return int(hashed.split('$')[2]) != log_rounds(app)
+    except (IndexError, ValueError):
+        return True
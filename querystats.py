@@ -0,0 +1,216 @@
+"""Per-request SQL statistics for Warbler.
+
+Engine events time every statement a request runs. When the request ends
+we log one structured line (statement count, time spent in the database,
+the slowest statements) under the 'warbler.queries' logger, and add it to
+per-endpoint totals that are logged every QUERY_STATS_SUMMARY_INTERVAL
+seconds and available from query_stats.summary().
+
+A statement run QUERY_STATS_REPEAT_THRESHOLD or more times in one request
+is almost always a lazy load in a loop (N+1); those requests are logged
+at WARNING with the repeated statements.
+
+The per-statement work is a clock read and a dict increment, so this is
+meant to stay on in production.
+"""
+
+import heapq
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.queries')
+
+DEFAULT_SLOWEST = 3
+DEFAULT_REPEAT_THRESHOLD = 5
+DEFAULT_SUMMARY_INTERVAL = 300
+
+
+def statement_shape(statement, length=200):
+    """`statement` on one line and cut short, for logs.
+
+    A long SELECT list goes first, so that what remains shows the FROM
+    and WHERE clauses: which table was queried, and how.
+    """
+
+    shape = re.sub(r'\s+', ' ', statement).strip()
+    if len(shape) > length:
+        shape = re.sub(r'^(SELECT (?:DISTINCT )?).+? FROM ', r'\1... FROM ',
+                       shape, count=1)
+    return shape if len(shape) <= length else shape[:length - 3] + '...'
+
+
+class RequestQueries:
+    """Statements run during one request."""
+
+    __slots__ = ('count', 'seconds', 'slowest', 'statements')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = []           # min-heap of (seconds, statement)
+        self.statements = Counter()
+
+    def add(self, statement, seconds, keep):
+        self.count += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+
+        if len(self.slowest) < keep:
+            heapq.heappush(self.slowest, (seconds, statement))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, statement))
+
+    def repeated(self, threshold):
+        """(statement, times run) for statements run `threshold`+ times."""
+
+        return [(statement, times)
+                for statement, times in self.statements.most_common()
+                if times >= threshold]
+
+
+class QueryStats:
+    """Collects RequestQueries for an app and totals them per endpoint."""
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self._next_summary = 0
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_STATS_SLOWEST', DEFAULT_SLOWEST)
+        app.config.setdefault('QUERY_STATS_REPEAT_THRESHOLD',
+                              DEFAULT_REPEAT_THRESHOLD)
+        app.config.setdefault('QUERY_STATS_SUMMARY_INTERVAL',
+                              DEFAULT_SUMMARY_INTERVAL)
+
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+
+        app.before_request(self._start_request)
+        app.after_request(self._record_status)
+        app.teardown_request(self._finish_request)
+
+        self._next_summary = (time.monotonic()
+                              + app.config['QUERY_STATS_SUMMARY_INTERVAL'])
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        if context is not None:
+            context._query_stats_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        if context is None or not has_request_context():
+            return
+
+        queries = g.get('queries')
+        if queries is not None:
+            queries.add(statement,
+                        time.perf_counter() - context._query_stats_start,
+                        current_app.config['QUERY_STATS_SLOWEST'])
+
+    def _start_request(self):
+        g.queries = RequestQueries()
+
+    def _record_status(self, response):
+        g.response_status = response.status_code
+        return response
+
+    def _finish_request(self, exc):
+        queries = g.pop('queries', None)
+        if queries is None:
+            return
+
+        config = current_app.config
+        endpoint = request.endpoint or 'unknown'
+        repeated = queries.repeated(config['QUERY_STATS_REPEAT_THRESHOLD'])
+
+        entry = {
+            'endpoint': endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': g.get('response_status', 500),
+            'statements': queries.count,
+            'db_ms': round(queries.seconds * 1000, 2),
+            'slowest': [{'ms': round(seconds * 1000, 2),
+                         'statement': statement_shape(statement)}
+                        for seconds, statement
+                        in sorted(queries.slowest, reverse=True)],
+        }
+        if repeated:
+            entry['repeated'] = [{'times': times,
+                                  'statement': statement_shape(statement)}
+                                 for statement, times in repeated]
+
+        logger.log(logging.WARNING if repeated else logging.INFO,
+                   json.dumps(entry))
+
+        self._aggregate(endpoint, queries, bool(repeated))
+        self._maybe_log_summary()
+
+    def _aggregate(self, endpoint, queries, repeated):
+        keep = current_app.config['QUERY_STATS_SLOWEST']
+
+        with self._lock:
+            totals = self._endpoints.setdefault(endpoint, {
+                'requests': 0, 'statements': 0, 'max_statements': 0,
+                'db_seconds': 0.0, 'repeated_requests': 0, 'slowest': [],
+            })
+            totals['requests'] += 1
+            totals['statements'] += queries.count
+            totals['max_statements'] = max(totals['max_statements'],
+                                           queries.count)
+            totals['db_seconds'] += queries.seconds
+            totals['repeated_requests'] += repeated
+
+            slowest = totals['slowest']
+            for item in queries.slowest:
+                if len(slowest) < keep:
+                    heapq.heappush(slowest, item)
+                elif item[0] > slowest[0][0]:
+                    heapq.heapreplace(slowest, item)
+
+    def _maybe_log_summary(self):
+        now = time.monotonic()
+        if now < self._next_summary:
+            return
+
+        interval = current_app.config['QUERY_STATS_SUMMARY_INTERVAL']
+        self._next_summary = now + interval
+        logger.info(json.dumps({'summary': self.summary()}))
+
+    def summary(self):
+        """Totals per endpoint since startup (or the last reset())."""
+
+        with self._lock:
+            return {
+                endpoint: {
+                    'requests': t['requests'],
+                    'statements_mean': round(t['statements'] / t['requests'],
+                                             1),
+                    'statements_max': t['max_statements'],
+                    'db_ms_mean': round(t['db_seconds'] * 1000
+                                        / t['requests'], 2),
+                    'repeated_requests': t['repeated_requests'],
+                    'slowest': [{'ms': round(seconds * 1000, 2),
+                                 'statement': statement_shape(statement)}
+                                for seconds, statement
+                                in sorted(t['slowest'], reverse=True)],
+                }
+                for endpoint, t in self._endpoints.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+query_stats = QueryStats()
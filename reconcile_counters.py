@@ -0,0 +1,15 @@
+"""Recompute the denormalized per-user counters (messages, follows, likes).
+
+The counters are kept up to date as rows change; run this to repair them
+after bulk loads or manual edits to the database:
+
+    python reconcile_counters.py
+"""
+
+from app import app, db
+from models import User
+
+
+with app.app_context():
+    User.reconcile_counters()
+    db.session.commit()
@@ -0,0 +1,359 @@
+"""Username and message search for Warbler.
+
+search_users() ranks matches exact > prefix > substring and returns at most
+one bounded page. Exact and prefix matches come from the C-collated btree on
+lower(username) (see models.py), which serves both the LIKE 'q%' range and
+the ordering. Substring matches use the pg_trgm index when the server has it (ranked by
+similarity); without it they fall back to a LIMITed ILIKE scan.
+
+Autocomplete is answered from memory: username_index keeps every username
+in a sorted list and finds a prefix with bisect. Each process refreshes it
+from the database every USERNAME_INDEX_TTL seconds, and follows signups,
+renames and deletions as they are committed (see changes.py).
+
+Without a query, /users is an alphabetical directory read a page at a time
+by directory_users() along the unique username index.
+
+Message search runs against messages.search_vector, a generated tsvector
+column with a GIN index, so PostgreSQL keeps the inverted index current as
+messages are posted and deleted. Results are ordered by a score mixing text
+relevance with recency (see message_score) within windows of
+MESSAGE_SEARCH_CANDIDATES matches: ranking reads each match's whole
+tsvector, so a common term would otherwise rank every message that has it
+before the LIMIT. The newest window is ranked first; once it runs out the
+results go on with the next older one. A window is an id range, which the
+(lo, hi, score, id) cursor carries, so paging stays inside it even as new
+messages match.
+"""
+
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+
+from flask import current_app
+from sqlalchemy import Float, func, tuple_
+
+from changes import changes, UserChanged
+from models import db, Message, User
+
+DEFAULT_SEARCH_LIMIT = 50
+DEFAULT_AUTOCOMPLETE_LIMIT = 10
+DEFAULT_USERNAME_INDEX_TTL = 300
+DEFAULT_RECENCY_HALF_LIFE = 7 * 24 * 3600
+DEFAULT_SEARCH_CANDIDATES = 1000
+
+SEARCH_CONFIG = 'english'
+
+_trigram_index = {}
+
+
+def has_trigram_index():
+    """Does this database have the pg_trgm username index? (cached)"""
+
+    url = str(db.engine.url)
+
+    if url not in _trigram_index:
+        _trigram_index[url] = db.session.execute(
+            "SELECT 1 FROM pg_indexes "
+            "WHERE indexname = 'ix_users_username_trgm'"
+        ).scalar() is not None
+
+    return _trigram_index[url]
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in user input (with '\\' as the escape)."""
+
+    return (text.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+def search_users(query, limit=None):
+    """Users whose username contains `query`, best matches first.
+
+    Case-insensitive. An exact match comes first, then usernames starting
+    with `query` (alphabetically), then the rest.
+    """
+
+    if limit is None:
+        limit = current_app.config.get('USER_SEARCH_LIMIT',
+                                       DEFAULT_SEARCH_LIMIT)
+
+    query = query.strip().lower()
+    if not query:
+        return []
+
+    pattern = escape_like(query)
+    lowered = func.lower(User.username).collate('C')
+
+    # a string sorts before everything it is a prefix of, so the exact
+    # match (if any) is first here
+    users = (User
+             .query
+             .filter(lowered.like(f"{pattern}%", escape='\\'))
+             .order_by(lowered)
+             .limit(limit)
+             .all())
+
+    if len(users) < limit:
+        substring = (User
+                     .query
+                     .filter(User.username.ilike(f"%{pattern}%", escape='\\'),
+                             ~lowered.like(f"{pattern}%", escape='\\')))
+
+        if has_trigram_index():
+            substring = substring.order_by(
+                func.similarity(User.username, query).desc(), User.username)
+        else:
+            substring = substring.order_by(User.username)
+
+        users.extend(substring.limit(limit - len(users)))
+
+    return users
+
+
+class UsernameIndex:
+    """Sorted in-memory list of usernames for prefix lookups."""
+
+    def __init__(self):
+        self._entries = []      # sorted (lowercase username, id)
+        self._usernames = {}    # id -> username
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def _refresh_if_stale(self):
+        ttl = current_app.config.get('USERNAME_INDEX_TTL',
+                                     DEFAULT_USERNAME_INDEX_TTL)
+        if self._expires > time.monotonic():
+            return
+
+        rows = db.session.query(User.id, User.username).all()
+
+        with self._lock:
+            self._usernames = dict(rows)
+            self._entries = sorted((username.lower(), user_id)
+                                   for user_id, username in rows)
+            self._expires = time.monotonic() + ttl
+
+    def complete(self, prefix, limit=None):
+        """Up to `limit` (id, username) pairs whose username starts with
+        `prefix` (case-insensitive), alphabetically."""
+
+        if limit is None:
+            limit = current_app.config.get('AUTOCOMPLETE_LIMIT',
+                                           DEFAULT_AUTOCOMPLETE_LIMIT)
+
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        self._refresh_if_stale()
+
+        matches = []
+
+        with self._lock:
+            position = bisect_left(self._entries, (prefix,))
+
+            for lowered, user_id in self._entries[position:position + limit]:
+                if not lowered.startswith(prefix):
+                    break
+                matches.append((user_id, self._usernames[user_id]))
+
+        return matches
+
+    def add(self, user_id, username):
+        """Add a user, or update them if their username changed."""
+
+        with self._lock:
+            self._discard(user_id)
+            self._usernames[user_id] = username
+            insort(self._entries, (username.lower(), user_id))
+
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id):
+        username = self._usernames.pop(user_id, None)
+
+        if username is not None:
+            entry = (username.lower(), user_id)
+            position = bisect_left(self._entries, entry)
+            if self._entries[position:position + 1] == [entry]:
+                del self._entries[position]
+
+    def clear(self):
+        """Forget everything; the next lookup reloads from the database."""
+
+        with self._lock:
+            self._entries = []
+            self._usernames = {}
+            self._expires = 0
+
+
+username_index = UsernameIndex()
+
+
+def index_changed_user(change):
+    if change.deleted:
+        username_index.remove(change.user_id)
+    elif change.username is not None:
+        username_index.add(change.user_id, change.username)
+
+
+changes.subscribe(UserChanged, index_changed_user)
+
+
+def directory_users(limit=100, before=None, after=None):
+    """Users in username order, for the /users directory.
+
+    `before`/`after` are (username, id) keys as for keyset_page(), with
+    "older" meaning further down the alphabet: `before` continues after
+    the key, `after` walks back towards the top (nearest first).
+    Usernames are unique, so the username alone positions the page.
+    """
+
+    query = User.query
+
+    if after:
+        query = (query
+                 .filter(User.username < after[0])
+                 .order_by(User.username.desc()))
+    else:
+        if before:
+            query = query.filter(User.username > before[0])
+        query = query.order_by(User.username)
+
+    return query.limit(limit).all()
+
+
+def username_key(user):
+    """Cursor key of a directory entry."""
+
+    return user.username, user.id
+
+
+USERNAME_KEY_TYPES = (str, int)
+
+
+def message_score(tsquery):
+    """Ranking score of a message for `tsquery`.
+
+    log(relevance) + age bonus, where a message MESSAGE_SEARCH_HALF_LIFE
+    seconds newer counts as twice as relevant. It depends only on the message, not
+    on the current time, so it is stable enough to page through.
+    """
+
+    half_life = current_app.config.get('MESSAGE_SEARCH_HALF_LIFE',
+                                       DEFAULT_RECENCY_HALF_LIFE)
+
+    # normalization 32 scales the rank into (0, 1)
+    relevance = func.ts_rank_cd(Message.search_vector, tsquery, 32)
+    age = db.cast(db.extract('epoch', Message.timestamp), Float)
+
+    return (func.ln(func.greatest(relevance, 1e-9))
+            + age * (math.log(2) / half_life))
+
+
+def candidate_window(tsquery, below=None, above=None):
+    """The (lo, hi) id range of the next MESSAGE_SEARCH_CANDIDATES messages
+    matching `tsquery`, going down from id `below` or up from id `above`
+    (the newest ones with neither). None when there are no more."""
+
+    ids = (db.session
+           .query(Message.id)
+           .filter(Message.search_vector.op('@@')(tsquery)))
+
+    if above is not None:
+        ids = ids.filter(Message.id > above).order_by(Message.id)
+    else:
+        if below is not None:
+            ids = ids.filter(Message.id < below)
+        ids = ids.order_by(Message.id.desc())
+
+    ids = [row[0] for row in
+           ids.limit(current_app.config.get('MESSAGE_SEARCH_CANDIDATES',
+                                            DEFAULT_SEARCH_CANDIDATES))]
+
+    return (min(ids), max(ids)) if ids else None
+
+
+def ranked_window(tsquery, window, limit, position=None, newer=False):
+    """Up to `limit` matches with ids in `window`, ranked.
+
+    Best first from the (score, id) `position` on, or worst first back
+    from it if `newer`.
+    """
+
+    score = message_score(tsquery).label('score')
+    key = tuple_(score, Message.id)
+    lo, hi = window
+
+    query = (db.session
+             .query(Message, score)
+             .options(db.joinedload(Message.user))
+             .filter(Message.search_vector.op('@@')(tsquery),
+                     Message.id.between(lo, hi)))
+
+    if position:
+        position = tuple_(db.cast(position[0], Float), position[1])
+        query = query.filter(key > position if newer else key < position)
+
+    if newer:
+        query = query.order_by(score, Message.id)
+    else:
+        query = query.order_by(score.desc(), Message.id.desc())
+
+    messages = []
+    for msg, msg_score in query.limit(limit):
+        msg.search_score = msg_score
+        msg.search_window = window
+        messages.append(msg)
+
+    return messages
+
+
+def search_messages(text, limit=100, before=None, after=None):
+    """Messages matching the search `text`, best first.
+
+    `text` uses web search syntax ("quoted phrases", -excluded, or).
+    `before`/`after` are (lo, hi, score, id) keys as for keyset_page();
+    each returned message has its key's score in `search_score` and its
+    window in `search_window`. A page that empties its window goes on in
+    the next one, older going down and newer going back up.
+    """
+
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, text)
+    cursor = after or before
+    newer = bool(after)
+
+    if cursor:
+        window, position = cursor[:2], cursor[2:]
+    else:
+        window, position = candidate_window(tsquery), None
+
+    messages = []
+
+    while window is not None:
+        messages.extend(ranked_window(tsquery, window,
+                                      limit - len(messages), position, newer))
+        if len(messages) >= limit:
+            break
+
+        lo, hi = window
+        window = (candidate_window(tsquery, above=hi) if newer
+                  else candidate_window(tsquery, below=lo))
+        position = None
+
+    return messages
+
+
+def search_key(msg):
+    """Cursor key of a search result."""
+
+    return (*msg.search_window, msg.search_score, msg.id)
+
+
+SEARCH_KEY_TYPES = (int, int, float, int)
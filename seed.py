@@ -1,20 +1,27 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+The CSVs are streamed in with bulkload.py (COPY on PostgreSQL); pass a
+directory to load a different data set, e.g. one made by the generator:
 
+    python seed.py [generator/]
+"""
 
-db.drop_all()
-db.create_all()
+import sys
+
+from app import app, db
+from bulkload import load
+from models import User
+from timelines import rebuild_timelines
+from migrations import stamp
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+db.drop_all()
+db.create_all()
+stamp()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+with app.app_context():
+    load(db.engine, sys.argv[1] if len(sys.argv) > 1 else 'generator')
 
-db.session.commit()
+    User.reconcile_counters()
+    rebuild_timelines()
+    db.session.commit()
@@ -0,0 +1,104 @@
+"""Time-ordered ids for Warbler's messages.
+
+An id is a 63-bit integer built like a snowflake:
+
+    milliseconds since EPOCH    41 bits     (good until 2079)
+    worker                      10 bits
+    sequence                    12 bits     (4096 ids per worker per ms)
+
+so ids sort by creation time, and the time a message was posted can be
+read back from its id (timestamp_of()). Ids are made in the process, with
+no round trip to the database.
+
+Each process needs a worker number of its own: two processes sharing one
+make the same id when both post in the same millisecond. A generator asks
+its `claim` function for one once per process (after a fork, again); the
+app claims them from the database (see models.claim_worker_number()).
+Without a claim the number comes from the process id, which can clash
+across hosts or after pids wrap, so inserts should still expect the odd
+duplicate key.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+EPOCH = datetime(2010, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+def timestamp_of(id):
+    """When `id` was made, as a naive UTC datetime (to the millisecond)."""
+
+    return EPOCH + timedelta(milliseconds=id >> TIME_SHIFT)
+
+
+def id_floor(timestamp):
+    """The smallest id made at or after `timestamp` (naive UTC)."""
+
+    return ms_since_epoch(timestamp) << TIME_SHIFT
+
+
+def ms_since_epoch(timestamp):
+    return (timestamp - EPOCH) // timedelta(milliseconds=1)
+
+
+class IdGenerator:
+    """Makes unique, increasing ids for one worker, safe across threads."""
+
+    def __init__(self, worker=None, claim=None):
+        self._worker = worker
+        self.claim = claim      # () -> free worker number, or None
+        self._pid = None
+        self._derived = None
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    @property
+    def worker(self):
+        if self._worker is not None:
+            return self._worker
+
+        # re-derived after a fork, so each worker process gets its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._last_ms, self._sequence = -1, 0
+            claimed = self.claim() if self.claim else None
+            self._derived = (claimed if claimed is not None
+                             else os.getpid() & MAX_WORKER)
+
+        return self._derived
+
+    def now_ms(self):
+        return int(time.time() * 1000) - EPOCH_MS
+
+    def next_id(self):
+        with self._lock:
+            worker = self.worker
+            now = self.now_ms()
+
+            # the clock went back (or we are still in the same ms): carry
+            # on from the last ms used, so ids keep increasing
+            if now <= self._last_ms:
+                now = self._last_ms
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    now += 1        # 4096 ids this ms; borrow the next one
+            else:
+                self._sequence = 0
+
+            self._last_ms = now
+            return ((now << TIME_SHIFT) | (worker << SEQUENCE_BITS)
+                    | self._sequence)
+
+
+message_ids = IdGenerator()
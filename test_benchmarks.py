@@ -0,0 +1,60 @@
+"""Benchmark tests: the benchmarks must still run end to end."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmarks.py
+
+
+import argparse
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from benchmarks import routes
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RoutesBenchmarkTestCase(TestCase):
+
+    def setUp(self):
+        self.data = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.data.cleanup()
+        app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_tiny_run(self):
+        """Generate, seed and replay a few requests of every route."""
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        args = argparse.Namespace(requests=25, warmup=5, viewers=10,
+                                  seed='test', data=self.data.name)
+        mix = routes.parse_mix(routes.DEFAULT_MIX)
+
+        with app.test_request_context():
+            routes.seed(routes.dataset('tiny', args))
+            elapsed, samples = routes.replay(args, mix)
+
+        self.assertGreater(elapsed, 0)
+        self.assertEqual(sum(len(s) for s in samples.values()), 25)
+
+        statuses = [status for route in samples
+                    for _, _, status in samples[route]]
+        self.assertTrue(all(status < 400 for status in statuses), statuses)
+
+        for route in samples:
+            summary = routes.summarize(samples[route])
+            self.assertEqual(summary['errors'], 0)
+            self.assertGreater(summary['statements_mean'], 0)
@@ -0,0 +1,106 @@
+"""Bulk load tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulkload.py
+
+
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from models import db, User, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from bulkload import load, reset_sequences
+
+db.create_all()
+
+
+def write_csv(directory, name, columns, rows):
+    with open(os.path.join(directory, name), 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+class BulkLoadTestCase(TestCase):
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.directory = tempfile.TemporaryDirectory()
+        path = self.directory.name
+
+        write_csv(path, 'users.csv', ['email', 'username', 'password'],
+                  [[f'user{i}@test.com', f'user{i}', 'not-a-hash']
+                   for i in range(1, 4)])
+        write_csv(path, 'messages.csv',
+                  ['id', 'text', 'timestamp', 'user_id'],
+                  [[1, 'first', '2020-01-01 00:00:00', 1],
+                   [2, 'second', '2020-01-02 00:00:00', 2]])
+        write_csv(path, 'follows.csv',
+                  ['user_being_followed_id', 'user_following_id'],
+                  [[1, 2], [1, 3], [2, 3]])
+        write_csv(path, 'likes.csv', ['user_id', 'message_id'],
+                  [[2, 1], [3, 1], [3, 2]])
+
+    def tearDown(self):
+        self.directory.cleanup()
+        db.session.rollback()
+
+    def test_load(self):
+        loaded = load(db.engine, self.directory.name, chunk_rows=2,
+                      report=lambda line: None)
+
+        self.assertEqual(loaded, {'users': 3, 'messages': 2, 'follows': 3,
+                                  'likes': 3})
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual({(like.user_id, like.message_id)
+                          for like in Likes.query},
+                         {(2, 1), (3, 1), (3, 2)})
+
+        # the indexes and foreign keys dropped for the load are back
+        indexes = {row[0] for row in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'likes'")}
+        self.assertIn('ix_likes_message_id', indexes)
+        foreign_keys = db.session.execute(
+            "SELECT count(*) FROM pg_constraint "
+            "WHERE contype = 'f' AND conrelid = 'likes'::regclass").scalar()
+        self.assertEqual(foreign_keys, 2)
+
+    def test_reset_sequences(self):
+        load(db.engine, self.directory.name, report=lambda line: None)
+
+        # follows has no id column and is skipped
+        with db.engine.begin() as conn:
+            reset_sequences(conn, ['users', 'follows', 'likes'])
+
+        u = User.signup("newuser", "new@test.com", "password", None)
+        db.session.commit()
+        self.assertEqual(u.id, 4)
+
+        like = Likes(user_id=1, message_id=2)
+        db.session.add(like)
+        db.session.commit()
+        self.assertEqual(like.id, 4)
+
+    def test_load_sqlite(self):
+        # the executemany fallback, against the app's own schema
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+
+        loaded = load(engine, self.directory.name, chunk_rows=2,
+                      report=lambda line: None)
+
+        self.assertEqual(loaded, {'users': 3, 'messages': 2, 'follows': 3,
+                                  'likes': 3})
+        self.assertEqual(engine.execute(
+            "SELECT text FROM messages ORDER BY id").fetchall(),
+            [('first',), ('second',)])
@@ -1,8 +1,12 @@
 import os
+import threading
+from datetime import datetime, timedelta
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Message, Follows, Likes 
+from models import (db, User, Message, Follows, Likes, claim_worker_number,
+                    WORKER_LOCK_CLASS)
+from snowflake import IdGenerator, id_floor, timestamp_of
 
 os.environ['DATABASE_URL'] = 'postgresql:///warbler-test'
 
@@ -43,6 +47,57 @@ class UserModelTestCase(TestCase):
         self.assertEqual(len(self.u.messages), 1)
         self.assertEqual(self.u.messages[0].text, "a test message")
 
+    def test_message_ids_are_time_ordered(self):
+        before = datetime.utcnow() - timedelta(milliseconds=1)
+        messages = [Message(text=f"warble {i}", user_id=self.uid)
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        ids = [m.id for m in messages]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertGreaterEqual(ids[0], id_floor(before))
+
+        # each row gets its own timestamp, the one in its id
+        for m in Message.query.order_by(Message.id):
+            self.assertEqual(m.timestamp, timestamp_of(m.id))
+            self.assertLessEqual(m.timestamp - before, timedelta(minutes=1))
+
+    def test_id_generator(self):
+        ids = IdGenerator(worker=5)
+        ids.now_ms = lambda: 1000
+
+        # 4096 ids fit in a millisecond; then the next one is borrowed
+        made = [ids.next_id() for _ in range(4097)]
+        self.assertEqual(made, sorted(set(made)))
+        self.assertEqual(timestamp_of(made[0]),
+                         timestamp_of(0) + timedelta(seconds=1))
+        self.assertEqual(timestamp_of(made[-1]) - timestamp_of(made[0]),
+                         timedelta(milliseconds=1))
+
+        # the clock going back does not make ids go back
+        ids.now_ms = lambda: 500
+        self.assertGreater(ids.next_id(), made[-1])
+
+        # without a fixed worker, each process claims its own number
+        self.assertEqual(IdGenerator(claim=lambda: 7).worker, 7)
+        self.assertEqual(IdGenerator(claim=lambda: None).worker,
+                         os.getpid() & 1023)
+
+    def test_claim_worker_number(self):
+        first, second = claim_worker_number(), claim_worker_number()
+        self.assertIsNotNone(first)
+        self.assertNotEqual(first, second)
+
+        # held until this process exits, so no other process gets it
+        conn = db.engine.connect()
+        try:
+            self.assertFalse(conn.execute(
+                "SELECT pg_try_advisory_lock(%s, %s)",
+                (WORKER_LOCK_CLASS, first)).scalar())
+        finally:
+            conn.close()
+
     def test_message_likes(self):
         m1 = Message(
             text='to be liked',
@@ -55,10 +110,59 @@ class UserModelTestCase(TestCase):
         db.session.add_all([m1, u])
         db.session.commit()
 
-        u.likes.append(m1)
-
-        db.session.commit()
+        u.add_like(m1)
 
         testlike = Likes.query.filter(Likes.user_id == uid).all()
         self.assertEqual(len(testlike), 1)
         self.assertEqual(testlike[0].message_id, m1.id)
+        self.assertEqual(User.query.get(uid).like_count, 1)
+        self.assertEqual([msg.id for msg in u.likes], [m1.id])
+
+
+    def test_liked_message_ids(self):
+        m1 = Message(id=1, text='liked', user_id=self.uid)
+        m2 = Message(id=2, text='not liked', user_id=self.uid)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.uid, message_id=1))
+        db.session.commit()
+
+        self.assertEqual(self.u.liked_message_ids([1, 2, 3]), {1})
+        self.assertEqual(self.u.liked_message_ids([]), set())
+
+    def test_toggle_like(self):
+        m = Message(id=1, text='toggled', user_id=self.uid)
+        db.session.add(m)
+        db.session.commit()
+
+        self.assertTrue(self.u.toggle_like(m))
+        db.session.commit()
+        self.assertEqual(Likes.query.filter_by(user_id=self.uid).count(), 1)
+        self.assertEqual(User.query.get(self.uid).like_count, 1)
+
+        self.assertFalse(self.u.toggle_like(m))
+        db.session.commit()
+        self.assertEqual(Likes.query.filter_by(user_id=self.uid).count(), 0)
+        self.assertEqual(User.query.get(self.uid).like_count, 0)
+
+    def test_toggle_like_loses_race(self):
+        m = Message(id=1, text='raced', user_id=self.uid)
+        db.session.add(m)
+        db.session.commit()
+
+        # another toggle has inserted the like but not committed yet; ours
+        # waits on it, then finds the row there
+        other = db.engine.connect()
+        transaction = other.begin()
+        other.execute(Likes.__table__.insert(), user_id=self.uid, message_id=1)
+        threading.Timer(0.2, transaction.commit).start()
+
+        try:
+            self.assertTrue(self.u.toggle_like(m))
+            db.session.commit()
+        finally:
+            other.close()
+
+        self.assertEqual(Likes.query.filter_by(user_id=self.uid).count(), 1)
+        self.assertEqual(User.query.get(self.uid).like_count, 0)
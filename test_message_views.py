@@ -5,15 +5,24 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+import json
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Likes, Follows
+from models import db, connect_db, Message, User, Likes, Follows, TimelineEntry
 from bs4 import BeautifulSoup
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app, CURR_USER_KEY
+from changes import changes, FanoutChanged
+from fragments import FragmentCache, fragment_cache
+from pagination import encode_cursor
+from querystats import query_stats
+from snowflake import message_ids
+from timelines import clear_high_follower_cache
+from usercache import user_snapshots
 
 db.create_all()
 
@@ -29,6 +38,8 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        user_snapshots.clear()
+        fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -82,6 +93,236 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_add_message_retries_id_clash(self):
+        taken = Message(text="first", user_id=self.testuser_id)
+        db.session.add(taken)
+        db.session.commit()
+
+        # another worker with our worker number made the same id
+        made = iter([taken.id])
+        next_id = message_ids.next_id
+        message_ids.next_id = lambda: next(made, None) or next_id()
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                resp = c.post("/messages/new", data={"text": "second"})
+                self.assertEqual(resp.status_code, 302)
+
+            # ...and every time: a clear error, not a 500
+            message_ids.next_id = lambda: taken.id
+            with self.client as c:
+                resp = c.post("/messages/new", data={"text": "third"})
+                self.assertEqual(resp.status_code, 503)
+                self.assertIn("could not be posted", str(resp.data))
+        finally:
+            message_ids.next_id = next_id
+
+        self.assertEqual(sorted(m.text for m in Message.query),
+                         ["first", "second"])
+
+    def test_add_message_fans_out(self):
+        follower = User.signup("follower", "follower@test.com", "password", None)
+        follower.id = 2345
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=2345))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "Hello followers"})
+
+            msg = Message.query.one()
+            readers = {entry.user_id for entry in
+                       TimelineEntry.query.filter_by(message_id=msg.id)}
+            self.assertEqual(readers, {self.testuser_id, 2345})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2345
+
+            resp = c.get("/")
+            self.assertIn("Hello followers", str(resp.data))
+
+    def test_fan_out_trims_timelines(self):
+        follower = User.signup("follower", "follower@test.com", "password", None)
+        follower.id = 2345
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=2345))
+        db.session.commit()
+
+        app.config['TIMELINE_LENGTH'] = 2
+        app.config['TIMELINE_TRIM_EVERY'] = 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                for i in range(3):
+                    c.post("/messages/new", data={"text": f"warble {i}"})
+
+            newest = [msg.id for msg in
+                      Message.query.order_by(Message.id.desc()).limit(2)]
+
+            for uid in (self.testuser_id, 2345):
+                kept = [entry.message_id for entry in
+                        TimelineEntry.query.filter_by(user_id=uid)
+                        .order_by(TimelineEntry.message_id.desc())]
+                self.assertEqual(kept, newest)
+
+            # trimmed only now and then, timelines run over a little
+            app.config['TIMELINE_TRIM_EVERY'] = 1000000
+            with self.client as c:
+                for i in range(3):
+                    c.post("/messages/new", data={"text": f"more {i}"})
+
+            self.assertEqual(TimelineEntry.query
+                             .filter_by(user_id=2345).count(), 5)
+        finally:
+            app.config['TIMELINE_LENGTH'] = 800
+            app.config['TIMELINE_TRIM_EVERY'] = 50
+
+    def test_high_follower_messages_are_pulled(self):
+        for uid in (2345, 3456):
+            u = User.signup(f"fan{uid}", f"fan{uid}@test.com", "password", None)
+            u.id = uid
+        db.session.commit()
+
+        db.session.add_all([Follows(user_being_followed_id=self.testuser_id,
+                                    user_following_id=uid)
+                            for uid in (2345, 3456)])
+        db.session.commit()
+
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        clear_high_follower_cache()
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                c.post("/messages/new", data={"text": "Hello fans"})
+
+                msg = Message.query.one()
+                readers = {entry.user_id for entry in
+                           TimelineEntry.query.filter_by(message_id=msg.id)}
+                self.assertEqual(readers, {self.testuser_id})
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 2345
+
+                resp = c.get("/")
+                self.assertIn("Hello fans", str(resp.data))
+
+                resp = c.get("/users/2345")
+                self.assertIn("Hello fans", str(resp.data))
+        finally:
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = 10000
+            clear_high_follower_cache()
+
+    def test_dropping_below_threshold_pushes_messages(self):
+        for uid in (2345, 3456):
+            u = User.signup(f"fan{uid}", f"fan{uid}@test.com", "password", None)
+            u.id = uid
+        db.session.commit()
+
+        db.session.add_all([Follows(user_being_followed_id=self.testuser_id,
+                                    user_following_id=uid)
+                            for uid in (2345, 3456)])
+        db.session.commit()
+
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        clear_high_follower_cache()
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                c.post("/messages/new", data={"text": "Hello fans"})
+                msg = Message.query.one()
+
+                # one fan leaves: no longer pulled, so pushed to the other
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3456
+
+                c.post(f"/users/stop-following/{self.testuser_id}")
+
+            readers = {entry.user_id for entry in
+                       TimelineEntry.query.filter_by(message_id=msg.id)}
+            self.assertEqual(readers, {self.testuser_id, 2345})
+        finally:
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = 10000
+            clear_high_follower_cache()
+
+    def test_deleted_follower_pushes_messages(self):
+        for uid in (2345, 3456):
+            u = User.signup(f"fan{uid}", f"fan{uid}@test.com", "password", None)
+            u.id = uid
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=2345))
+        db.session.commit()
+
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        clear_high_follower_cache()
+        seen = []
+        changes.subscribe(FanoutChanged, seen.append)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3456
+
+                # a second follower takes the account over the threshold
+                c.post(f"/users/follow/{self.testuser_id}")
+                self.assertEqual(seen, [FanoutChanged(self.testuser_id,
+                                                      True)])
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                c.post("/messages/new", data={"text": "Hello fans"})
+                msg = Message.query.one()
+
+                # that follower deletes their account: back under it
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 3456
+
+                c.post("/users/delete")
+                self.assertEqual(seen[-1], FanoutChanged(self.testuser_id,
+                                                         False))
+
+            readers = {entry.user_id for entry in
+                       TimelineEntry.query.filter_by(message_id=msg.id)}
+            self.assertEqual(readers, {self.testuser_id, 2345})
+        finally:
+            changes.unsubscribe(FanoutChanged, seen.append)
+            app.config['TIMELINE_FANOUT_THRESHOLD'] = 10000
+            clear_high_follower_cache()
+
+    def test_delete_message_trims_timelines(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "Short lived"})
+            msg = Message.query.one()
+
+            resp = c.post(f"/messages/{msg.id}/delete")
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
     def test_message_unauthorized(self):
         with self.client as c:
             resp = c.post("/messages/new", data={"text": "Hello"}, follow_redirects=True)
@@ -119,6 +360,86 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(m.text, str(resp.data))
 
+    def test_message_not_modified(self):
+        m = Message(id=9876, text="testy test test",
+                    user_id=self.testuser_id)
+        db.session.add(m)
+        db.session.commit()
+
+        resp = self.client.get("/messages/9876")
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertNotIn('Last-Modified', resp.headers)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+        resp = self.client.get("/messages/9876", headers={
+            'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+
+        # the author renaming themselves changes the page, though not the
+        # message
+        User.query.get(self.testuser_id).username = "renamed"
+        db.session.commit()
+
+        resp = self.client.get("/messages/9876", headers={
+            'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@renamed", resp.get_data(as_text=True))
+
+        # the page differs for a logged-in viewer, and is theirs alone
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/messages/9876", headers={
+                'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Cache-Control'],
+                             'private, no-cache')
+
+    def test_static_fingerprints(self):
+        resp = self.client.get("/login")
+        soup = BeautifulSoup(resp.data, 'html.parser')
+        url = soup.select_one('link[rel="stylesheet"][href^="/static"]')['href']
+        self.assertRegex(url, r'^/static/stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+        # plain and outdated names still work, but must be revalidated
+        for url in ["/static/stylesheets/style.css",
+                    "/static/stylesheets/style.000000000000.css"]:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+    def test_fragment_cache_bounded(self):
+        db.session.add_all([Message(id=id, text=f"warble {id}",
+                                    user_id=self.testuser_id)
+                            for id in (1, 2, 3)])
+        db.session.commit()
+
+        with app.test_request_context():
+            one, two, three = Message.query.order_by(Message.id).all()
+
+            size = len(str(fragment_cache.message_item(one)).encode())
+            cache = FragmentCache(max_bytes=2 * size + 10)
+
+            cache.message_item(one)
+            cache.message_item(two)
+            self.assertIn("warble 1", cache.message_item(one))
+            cache.message_item(three)
+
+            # two was least recently used
+            self.assertEqual(len(cache), 2)
+            self.assertLessEqual(cache.size, cache.max_bytes)
+            self.assertNotIn(('message', 2), cache._entries)
+
+            cache.forget_message(1)
+            self.assertEqual(list(cache._entries), [('message', 3)])
+
     def test_invalid_message(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -128,4 +449,151 @@ class MessageViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 404)
 
-    
\ No newline at end of file
+    
+
+    def setup_search(self):
+        start = datetime(2020, 1, 1)
+        texts = [
+            (1, "birds singing in the morning", 0),
+            (2, "a bird, a bird, a singing bird", 0),
+            (3, "morning coffee", 1),
+            (4, "new bird feeder today", 30),
+            (5, "nothing to see here", 40),
+        ]
+        db.session.add_all([
+            Message(id=id, text=text, timestamp=start + timedelta(days=days),
+                    user_id=self.testuser_id)
+            for id, text, days in texts])
+        db.session.commit()
+
+    def search_ids(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        soup = BeautifulSoup(resp.data, 'html.parser')
+        ids = [int(a["href"].split("/")[-1])
+               for a in soup.select("#messages a.message-link")]
+        return ids, soup
+
+    def test_search_messages(self):
+        self.setup_search()
+
+        ids, _ = self.search_ids("/messages/search?q=birds")
+        # stemmed; recency outweighs the extra mentions in message 2
+        self.assertEqual(ids, [4, 2, 1])
+
+        ids, _ = self.search_ids('/messages/search?q=bird -feeder')
+        self.assertEqual(sorted(ids), [1, 2])
+
+        ids, soup = self.search_ids("/messages/search?q=zebra")
+        self.assertEqual(ids, [])
+        self.assertIn("no warbles found", soup.text)
+
+    def test_search_messages_pages(self):
+        self.setup_search()
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            ids, soup = self.search_ids("/messages/search?q=bird")
+            self.assertEqual(ids, [4, 2])
+
+            older = soup.find("a", string="Next")["href"]
+            self.assertTrue(older.startswith("?q=bird&before="))
+            ids, soup = self.search_ids("/messages/search" + older)
+            self.assertEqual(ids, [1])
+
+            newer = soup.find("a", string="Previous")["href"]
+            ids, _ = self.search_ids("/messages/search" + newer)
+            self.assertEqual(ids, [4, 2])
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 20
+
+        resp = self.client.get("/messages/search?q=bird&before=nonsense")
+        self.assertEqual(resp.status_code, 400)
+
+        for key in [('bird', 4), (datetime(2020, 1, 1), 4), (4,)]:
+            resp = self.client.get("/messages/search?q=bird&before="
+                                   + encode_cursor(*key))
+            self.assertEqual(resp.status_code, 400)
+
+    def test_search_ranks_candidate_windows(self):
+        self.setup_search()
+        db.session.add(Message(id=6, text="birds, birds, birds",
+                               timestamp=datetime(2019, 1, 1),
+                               user_id=self.testuser_id))
+        db.session.commit()
+        app.config['MESSAGE_SEARCH_CANDIDATES'] = 2
+        app.config['MESSAGES_PER_PAGE'] = 3
+
+        try:
+            # messages 1, 2, 4 and 6 match; the two with the newest ids
+            # are ranked first, then the next two, so the old post 6
+            # comes before 2 and 1, which outrank it
+            ids, soup = self.search_ids("/messages/search?q=bird")
+            self.assertEqual(ids, [4, 6, 2])
+
+            older = soup.find("a", string="Next")["href"]
+            ids, soup = self.search_ids("/messages/search" + older)
+            self.assertEqual(ids, [1])
+
+            newer = soup.find("a", string="Previous")["href"]
+            ids, _ = self.search_ids("/messages/search" + newer)
+            self.assertEqual(ids, [4, 6, 2])
+        finally:
+            app.config['MESSAGE_SEARCH_CANDIDATES'] = 1000
+            app.config['MESSAGES_PER_PAGE'] = 20
+
+    def test_search_follows_new_and_deleted_messages(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "Penguins are great"})
+            ids, _ = self.search_ids("/messages/search?q=penguin")
+            self.assertEqual(len(ids), 1)
+
+            c.post(f"/messages/{ids[0]}/delete")
+            ids, _ = self.search_ids("/messages/search?q=penguin")
+            self.assertEqual(ids, [])
+
+    def test_query_stats_per_request(self):
+        query_stats.reset()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser_id
+
+        # not inside `with self.client`, which would keep the request
+        # context (and its teardown, which logs) alive past assertLogs
+        with self.assertLogs('warbler.queries', 'INFO') as logs:
+            self.client.get("/")
+
+        entry = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(entry['endpoint'], 'warbler.homepage')
+        self.assertEqual(entry['status'], 200)
+        self.assertGreater(entry['statements'], 0)
+        self.assertLessEqual(len(entry['slowest']), 3)
+        self.assertNotIn('repeated', entry)
+
+        summary = query_stats.summary()['warbler.homepage']
+        self.assertEqual(summary['requests'], 1)
+        self.assertEqual(summary['statements_max'], entry['statements'])
+        self.assertEqual(summary['repeated_requests'], 0)
+
+    def test_query_stats_flags_repeated_statements(self):
+        query_stats.reset()
+
+        with app.test_request_context("/"):
+            query_stats._start_request()
+            for _ in range(5):
+                User.query.get(self.testuser_id)
+                db.session.expunge_all()
+
+            with self.assertLogs('warbler.queries', 'WARNING') as logs:
+                query_stats._finish_request(None)
+
+        entry = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(entry['repeated'][0]['times'], 5)
+        statement = entry['repeated'][0]['statement']
+        self.assertTrue(statement.startswith("SELECT ... FROM users"),
+                        statement)
+        summary = query_stats.summary()['warbler.homepage']
+        self.assertEqual(summary['repeated_requests'], 1)
@@ -0,0 +1,130 @@
+"""Migration tests: a database made before any migration upgrades cleanly."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import io
+import os
+from contextlib import redirect_stdout
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Message, TimelineEntry, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from migrations import MIGRATIONS, schema_migrations, upgrade
+from snowflake import timestamp_of
+
+db.create_all()
+
+# The schema as it was before migration 1.
+BASELINE_SCHEMA = [
+    """CREATE TABLE users (
+        id SERIAL PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL UNIQUE,
+        image_url TEXT,
+        header_image_url TEXT,
+        bio TEXT,
+        location TEXT,
+        password TEXT NOT NULL)""",
+    """CREATE TABLE follows (
+        user_being_followed_id INTEGER NOT NULL
+            REFERENCES users (id) ON DELETE CASCADE,
+        user_following_id INTEGER NOT NULL
+            REFERENCES users (id) ON DELETE CASCADE,
+        PRIMARY KEY (user_being_followed_id, user_following_id))""",
+    """CREATE TABLE messages (
+        id SERIAL PRIMARY KEY,
+        text VARCHAR(140) NOT NULL,
+        timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE)""",
+    """CREATE TABLE likes (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+        message_id INTEGER UNIQUE
+            REFERENCES messages (id) ON DELETE CASCADE)""",
+]
+
+
+def reset_schema():
+    db.session.rollback()
+    db.drop_all()
+    schema_migrations.drop(db.engine, checkfirst=True)
+
+
+class MigrationsTestCase(TestCase):
+
+    def setUp(self):
+        reset_schema()
+
+        with db.engine.begin() as conn:
+            for statement in BASELINE_SCHEMA:
+                conn.execute(statement)
+
+            conn.execute("""
+                INSERT INTO users (id, email, username, password)
+                VALUES (1, 'one@test.com', 'one', 'x'),
+                       (2, 'two@test.com', 'two', 'x')""")
+            conn.execute("""
+                INSERT INTO messages (id, text, timestamp, user_id)
+                VALUES (1, 'first', '2020-01-01 00:00:00.123456', 1),
+                       (2, 'second', '2020-01-02 00:00:00', 2),
+                       (3, 'same ms', '2020-01-02 00:00:00.0004', 1)""")
+            conn.execute("INSERT INTO follows VALUES (1, 2)")
+            conn.execute("""
+                INSERT INTO likes (user_id, message_id)
+                VALUES (2, 1), (1, 2)""")
+
+    def tearDown(self):
+        reset_schema()
+        db.create_all()
+
+    def test_upgrade_from_baseline(self):
+        with app.test_request_context(), redirect_stdout(io.StringIO()):
+            upgrade()
+
+        applied = {row.version for row in
+                   db.engine.execute(schema_migrations.select())}
+        self.assertEqual(applied, {mig.version for mig in MIGRATIONS})
+
+        # ids now follow the timestamps, cut to the millisecond; the two
+        # messages of the same millisecond keep their order
+        messages = {m.text: m for m in Message.query}
+        first, second, same_ms = (messages['first'], messages['second'],
+                                  messages['same ms'])
+        self.assertEqual(first.timestamp,
+                         datetime(2020, 1, 1, 0, 0, 0, 123000))
+        for msg in messages.values():
+            self.assertEqual(timestamp_of(msg.id), msg.timestamp)
+        self.assertLess(first.id, second.id)
+        self.assertEqual(same_ms.id, second.id + 1)
+
+        # likes and timelines were moved over to the new ids
+        one, two = User.query.get(1), User.query.get(2)
+        self.assertEqual([msg.id for msg in two.likes], [first.id])
+        self.assertEqual([msg.id for msg in one.likes], [second.id])
+        self.assertEqual(
+            [entry.message_id for entry in TimelineEntry.query
+             .filter_by(user_id=2).order_by(TimelineEntry.message_id)],
+            [first.id, second.id, same_ms.id])
+
+        self.assertEqual((one.message_count, one.follower_count,
+                          one.like_count), (2, 1, 1))
+        self.assertEqual((two.message_count, two.following_count,
+                          two.like_count), (1, 1, 1))
+
+        indexes = {row[0] for row in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'messages'")}
+        self.assertIn('ix_messages_user_id_id', indexes)
+        self.assertNotIn('ix_messages_user_id_timestamp', indexes)
+
+        # new messages get their ids from the app, after the old ones
+        msg = Message(text="new", user_id=1)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertGreater(msg.id, same_ms.id)
@@ -0,0 +1,176 @@
+"""Query plan tests: the main pages must not sequentially scan big tables."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import json
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from timelines import rebuild_timelines
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_USERS = 20000
+NUM_MESSAGES = 100000
+FOLLOWS_PER_USER = 10
+
+LARGE_TABLES = {'users', 'messages', 'follows', 'likes', 'timelines'}
+
+
+def seq_scans(plan):
+    """Names of large tables that `plan` (EXPLAIN JSON) scans sequentially."""
+
+    found = []
+
+    if plan.get('Node Type') == 'Seq Scan' and plan['Relation Name'] in LARGE_TABLES:
+        found.append(plan['Relation Name'])
+
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child))
+
+    return found
+
+
+class QueryPlanTestCase(TestCase):
+    """EXPLAIN the SQL that the main pages issue on a seeded large dataset."""
+
+    @classmethod
+    def setUpClass(cls):
+        db.drop_all()
+        db.create_all()
+
+        db.session.execute(f"""
+            INSERT INTO users (email, username, password)
+            SELECT 'user' || g || '@test.com', 'user' || g, 'not-a-hash'
+            FROM generate_series(1, {NUM_USERS}) g""")
+
+        db.session.execute(f"""
+            INSERT INTO messages (id, text, timestamp, user_id)
+            SELECT g, 'warble ' || g,
+                   timestamp '2020-01-01' + g * interval '1 minute',
+                   1 + g % {NUM_USERS}
+            FROM generate_series(1, {NUM_MESSAGES}) g""")
+
+        db.session.execute(f"""
+            INSERT INTO follows (user_following_id, user_being_followed_id)
+            SELECT u, 1 + (u - 1 + k * 37) % {NUM_USERS}
+            FROM generate_series(1, {NUM_USERS}) u,
+                 generate_series(1, {FOLLOWS_PER_USER}) k""")
+
+        db.session.execute(f"""
+            INSERT INTO likes (user_id, message_id)
+            SELECT 1 + m % {NUM_USERS}, m
+            FROM generate_series(1, {NUM_MESSAGES}, 2) m""")
+
+        with app.test_request_context():
+            rebuild_timelines()
+            db.session.commit()
+
+        db.session.execute("ANALYZE")
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def captured_selects(self, url):
+        """SELECT statements (with parameters) issued while GETting `url`.
+
+        The page is fetched once beforehand so that in-process caches are
+        warm and only the per-request queries are captured.
+        """
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            c.get(url)
+
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            try:
+                resp = c.get(url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', capture)
+
+        self.assertEqual(resp.status_code, 200)
+        return statements
+
+    def assertNoSeqScans(self, url):
+        statements = self.captured_selects(url)
+        self.assertTrue(statements)
+
+        cursor = db.session.connection().connection.cursor()
+
+        for statement, parameters in statements:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+
+            self.assertEqual(seq_scans(plan[0]['Plan']), [],
+                             f"sequential scan for {url}:\n{statement}")
+
+        db.session.rollback()
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_homepage(self):
+        self.assertNoSeqScans("/")
+
+    def test_user_profile(self):
+        self.assertNoSeqScans("/users/1")
+
+    def test_following(self):
+        self.assertNoSeqScans("/users/1/following")
+
+    def test_followers(self):
+        self.assertNoSeqScans("/users/1/followers")
+
+    def test_likes(self):
+        self.assertNoSeqScans("/users/1/likes")
+
+    def test_message(self):
+        self.assertNoSeqScans("/messages/1")
+
+    def test_username_prefix_search(self):
+        # more than USER_SEARCH_LIMIT prefix matches: no substring pass
+        self.assertNoSeqScans("/users?q=user12")
+
+    def test_username_search(self):
+        has_trgm = db.session.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_users_username_trgm'"
+        ).scalar()
+        db.session.rollback()
+
+        if not has_trgm:
+            self.skipTest("pg_trgm is not available on this server")
+
+        self.assertNoSeqScans("/users?q=ser12")
+
+    def test_message_search(self):
+        # every message says "warble"; its number is the selective term
+        self.assertNoSeqScans("/messages/search?q=4242")
+
+    def test_users_directory(self):
+        self.assertNoSeqScans("/users")
@@ -6,6 +6,7 @@
 
 
 import os
+import time
 from unittest import TestCase
 from sqlalchemy import exc
 
@@ -22,6 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from passwords import PasswordHasher, PasswordHasherBusy, get_hasher
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -30,6 +32,8 @@ from app import app
 
 db.create_all()
 
+app.config['WTF_CSRF_ENABLED'] = False
+
 
 class UserModelTestCase(TestCase):
     """Test views for messages."""
@@ -151,7 +155,7 @@ class UserModelTestCase(TestCase):
     # Following Tests
 
     def test_user_follows(self):
-        self.u1.following.append(self.u2)
+        self.u1.follow([self.uid2])
         db.session.commit()
 
         self.assertEqual(len(self.u1.following), 1)
@@ -161,17 +165,92 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(self.u1.following[0].id, self.u2.id)
         self.assertEqual(self.u2.followers[0].id, self.u1.id)
+        self.assertEqual(User.query.get(self.uid2).follower_count, 1)
 
     def test_is_following(self):
-        self.u1.following.append(self.u2)
+        self.u1.follow([self.uid2])
         db.session.commit()
 
         self.assertTrue(self.u1.is_following(self.u2))
         self.assertFalse(self.u2.is_following(self.u1))
 
     def test_is_followed_by(self):
-        self.u1.following.append(self.u2)
+        self.u1.follow([self.uid2])
         db.session.commit()
 
         self.assertTrue(self.u2.is_followed_by(self.u1))
-        self.assertFalse(self.u1.is_followed_by(self.u2))
\ No newline at end of file
+        self.assertFalse(self.u1.is_followed_by(self.u2))
+
+    def test_follow_states(self):
+        u3 = User.signup("testuser3", "test3@test.com", "password", None)
+        u3.id = 3333
+        db.session.commit()
+
+        self.u1.follow([self.uid2])
+        u3.follow([self.uid1])
+        self.u2.follow([self.uid1])
+        db.session.commit()
+
+        following, followed_by = self.u1.follow_states([self.uid2, 3333, 9999])
+        self.assertEqual(following, {self.uid2})
+        self.assertEqual(followed_by, {self.uid2, 3333})
+
+        self.assertEqual(self.u1.follow_states([]), (set(), set()))
+        self.assertEqual(self.u1.following_ids(), {self.uid2})
+
+
+    # Password hashing
+
+    def test_rehash_on_login(self):
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+        try:
+            u = User.authenticate(self.u1.username, "password")
+            self.assertTrue(u.password.startswith("$2b$04$"))
+
+            u = User.authenticate(self.u1.username, "password")
+            self.assertEqual(u.id, self.uid1)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+    def test_hasher_fails_fast_when_saturated(self):
+        hasher = PasswordHasher(workers=0, queue_limit=1)
+        hasher._slots.acquire()
+
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.run(len, "password")
+
+        hasher._slots.release()
+        self.assertEqual(hasher.run(len, "password"), 8)
+
+    def test_hasher_timeout_keeps_slot(self):
+        hasher = PasswordHasher(workers=1, queue_limit=1, timeout=0.1)
+
+        try:
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.run(time.sleep, 0.5)
+
+            # still sleeping in the pool, so still holding the only slot
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.run(len, "password")
+
+            time.sleep(0.6)
+            self.assertEqual(hasher.run(len, "password"), 8)
+        finally:
+            hasher.shutdown()
+
+    def test_login_when_hasher_busy(self):
+        hasher = get_hasher(app)
+        held = 0
+
+        try:
+            while hasher._slots.acquire(blocking=False):
+                held += 1
+
+            resp = self.client.post("/login", data={"username": "testuser1",
+                                                    "password": "password"})
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn("Please try again", str(resp.data))
+        finally:
+            for _ in range(held):
+                hasher._slots.release()
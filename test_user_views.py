@@ -3,26 +3,51 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+import json
 import os
+import select
+import tempfile
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Likes, Follows
+from models import db, connect_db, Message, User, Likes, Follows, TimelineEntry
 from bs4 import BeautifulSoup
+from sqlalchemy import event
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
-from app import app, CURR_USER_KEY
+from app import app, create_app, CURR_USER_KEY
+from timelines import rebuild_timelines
+from search import username_index
+from usercache import user_snapshots
+from changes import (changes, decode, record, FollowChanged, UserChanged,
+                     LikeChanged)
+from fragments import fragment_cache
+from metrics import metrics
+from pagination import encode_cursor
 
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+
+def in_flight():
+    """This process's warbler_requests_in_flight gauge, which requests
+    left open by other tests may hold above zero."""
+
+    return sum(value for name, _, value in metrics.registry.snapshot()
+               if name == 'warbler_requests_in_flight')
+
+
 class UserViewsTestCase(TestCase):
 
     def setUp(self):
 
         db.drop_all()
         db.create_all()
+        user_snapshots.clear()
+        username_index.clear()
+        fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -74,6 +99,174 @@ class UserViewsTestCase(TestCase):
             self.assertNotIn("@ghi", str(resp.data))
             self.assertNotIn("@jkl", str(resp.data))
 
+    def setup_search(self):
+        for username in ["test", "Testing", "atest", "tester", "test_100"]:
+            User.signup(username, f"{username}@search.com", "password", None)
+        db.session.commit()
+
+    def search_results(self, url):
+        resp = self.client.get(url)
+        soup = BeautifulSoup(resp.data, 'html.parser')
+        return [p.text for p in soup.select(".card-link p")]
+
+    def test_users_search_ranking(self):
+        self.setup_search()
+
+        self.assertEqual(self.search_results("/users?q=TEST"),
+                         ["@test", "@test_100", "@tester", "@Testing",
+                          "@testuser", "@atest"])
+
+    def test_users_search_escapes_wildcards(self):
+        self.setup_search()
+
+        self.assertEqual(self.search_results("/users?q=t_"), ["@test_100"])
+        self.assertEqual(self.search_results("/users?q=%25"), [])
+
+    def test_users_search_bounded(self):
+        self.setup_search()
+        app.config['USER_SEARCH_LIMIT'] = 3
+
+        try:
+            self.assertEqual(self.search_results("/users?q=test"),
+                             ["@test", "@test_100", "@tester"])
+        finally:
+            app.config['USER_SEARCH_LIMIT'] = 50
+
+    def test_users_directory_pages(self):
+        app.config['USERS_PER_PAGE'] = 2
+
+        try:
+            resp = self.client.get("/users")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            self.assertEqual([p.text for p in soup.select(".card-link p")],
+                             ["@abc", "@def"])
+            self.assertIsNone(soup.find("a", string="Previous"))
+
+            following = soup.find("a", string="Next")["href"]
+            self.assertEqual(self.search_results("/users" + following),
+                             ["@ghi", "@jkl"])
+
+            resp = self.client.get("/users" + following)
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            following = soup.find("a", string="Next")["href"]
+            self.assertEqual(self.search_results("/users" + following),
+                             ["@testuser"])
+
+            resp = self.client.get("/users" + following)
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            self.assertIsNone(soup.find("a", string="Next"))
+            previous = soup.find("a", string="Previous")["href"]
+            self.assertEqual(self.search_results("/users" + previous),
+                             ["@ghi", "@jkl"])
+        finally:
+            app.config['USERS_PER_PAGE'] = 60
+
+        resp = self.client.get("/users?before=nonsense")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_autocomplete(self):
+        self.setup_search()
+
+        resp = self.client.get("/users/autocomplete?q=TES")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([u["username"] for u in resp.json],
+                         ["test", "test_100", "tester", "Testing", "testuser"])
+
+        self.assertEqual(self.client.get("/users/autocomplete").json, [])
+
+    def test_autocomplete_sees_signup_and_edit(self):
+        self.assertEqual(self.client.get("/users/autocomplete?q=n").json, [])
+
+        with self.client as c:
+            c.post("/signup", data={"username": "newbie",
+                                    "email": "newbie@test.com",
+                                    "password": "password"})
+            resp = c.get("/users/autocomplete?q=n")
+            self.assertEqual([u["username"] for u in resp.json], ["newbie"])
+
+            c.post("/users/profile", data={"username": "zed",
+                                           "email": "newbie@test.com",
+                                           "password": "password"})
+            self.assertEqual(c.get("/users/autocomplete?q=n").json, [])
+            self.assertEqual([u["username"] for u in
+                              c.get("/users/autocomplete?q=z").json], ["zed"])
+
+    def test_message_fragments_follow_profile_edits(self):
+        db.session.add(Message(id=100, text="warble", user_id=self.testuser_id))
+        db.session.commit()
+
+        with app.test_request_context():
+            rebuild_timelines()
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            soup = BeautifulSoup(c.get("/").data, 'html.parser')
+            self.assertEqual(soup.select_one("#messages .message-area a").text,
+                             "@testuser")
+            self.assertEqual(len(fragment_cache), 1)
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "password"})
+            self.assertEqual(len(fragment_cache), 0)
+
+            soup = BeautifulSoup(c.get("/").data, 'html.parser')
+            self.assertEqual(soup.select_one("#messages .message-area a").text,
+                             "@renamed")
+            # the like button is still the viewer's own
+            self.assertEqual(len(soup.select("#messages form")), 1)
+
+    def test_change_events_after_commit(self):
+        seen = []
+        for event_type in (UserChanged, FollowChanged):
+            changes.subscribe(event_type, seen.append)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                c.post(f"/users/follow/{self.u1_id}")
+
+            self.assertCountEqual(seen, [
+                FollowChanged(self.testuser_id, self.u1_id, False),
+                UserChanged(self.testuser_id, None, False),
+                UserChanged(self.u1_id, None, False),
+            ])
+
+            # nothing is published for a transaction that rolls back
+            seen.clear()
+            User.query.get(self.u2_id).bio = "changed"
+            db.session.flush()
+            db.session.rollback()
+            self.assertEqual(seen, [])
+
+        finally:
+            for event_type in (UserChanged, FollowChanged):
+                changes.unsubscribe(event_type, seen.append)
+
+    def test_change_events_notify_other_processes(self):
+        connection = db.engine.raw_connection()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN "{app.config["CHANGES_CHANNEL"]}"')
+
+            with app.test_request_context():
+                record(db.session, LikeChanged(self.u1_id, 42, False))
+                db.session.commit()
+
+            select.select([dbapi_connection], [], [], 5)
+            dbapi_connection.poll()
+            _, events = decode(dbapi_connection.notifies.pop().payload)
+            self.assertEqual(events, [LikeChanged(self.u1_id, 42, False)])
+        finally:
+            connection.close()
+
     def test_user_exists(self):
         with self.client as c:
             resp = c.get(f"/users/{self.testuser_id}")
@@ -250,4 +443,506 @@ class UserViewsTestCase(TestCase):
             resp = c.get(f"/users/{self.testuser_id}/followers", follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn("@abc", str(resp.data))
-            self.assertIn("Access unauthorized.", str(resp.data))
\ No newline at end of file
+            self.assertIn("Access unauthorized.", str(resp.data))
+
+    def test_follow_backfills_timeline(self):
+        m = Message(id=5678, text="catch up on this", user_id=self.u3_id)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/")
+            self.assertNotIn("catch up on this", str(resp.data))
+
+            c.post(f"/users/follow/{self.u3_id}")
+
+            resp = c.get("/")
+            self.assertIn("catch up on this", str(resp.data))
+
+    def test_unfollow_prunes_timeline(self):
+        m = Message(id=5678, text="soon to be gone", user_id=self.u3_id)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.u3_id}")
+            c.post(f"/users/stop-following/{self.u3_id}")
+
+            entries = TimelineEntry.query.filter_by(user_id=self.testuser_id)
+            self.assertEqual(entries.count(), 0)
+
+            resp = c.get("/")
+            self.assertNotIn("soon to be gone", str(resp.data))
+
+    def test_profile_pages_by_cursor(self):
+        start = datetime(2020, 1, 1)
+        db.session.add_all([
+            Message(id=100 + i, text=f"warble number {i}",
+                    timestamp=start + timedelta(minutes=i),
+                    user_id=self.testuser_id)
+            for i in range(5)
+        ])
+        db.session.commit()
+
+        with app.test_request_context():
+            rebuild_timelines()
+            db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                resp = c.get(f"/users/{self.testuser_id}")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                texts = [p.text for p in soup.select("#messages p")]
+                self.assertEqual(texts, ["warble number 4", "warble number 3"])
+                self.assertIsNone(soup.find("a", string="Newer"))
+
+                older = soup.find("a", string="Older")["href"]
+                resp = c.get(f"/users/{self.testuser_id}{older}")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                texts = [p.text for p in soup.select("#messages p")]
+                self.assertEqual(texts, ["warble number 2", "warble number 1"])
+
+                newer = soup.find("a", string="Newer")["href"]
+                resp = c.get(f"/users/{self.testuser_id}{newer}")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                texts = [p.text for p in soup.select("#messages p")]
+                self.assertEqual(texts, ["warble number 4", "warble number 3"])
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 20
+
+    def test_profile_not_modified(self):
+        db.session.add(Message(id=100, text="warble", user_id=self.testuser_id))
+        db.session.commit()
+
+        with app.test_request_context():
+            rebuild_timelines()
+            db.session.commit()
+
+        url = f"/users/{self.testuser_id}"
+        etag = self.client.get(url).headers['ETag']
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        # a new follower changes the counts on the page
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=self.u1_id))
+        db.session.commit()
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        # a date alone never validates a page
+        resp = self.client.get(url, headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Last-Modified', resp.headers)
+
+    def test_invalid_cursor(self):
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser_id}?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+            # well-formed, but the key of another kind of list
+            score = encode_cursor(1.5, 2)
+            resp = c.get(f"/users/{self.testuser_id}?before={score}")
+            self.assertEqual(resp.status_code, 400)
+            resp = c.get(f"/users?after={score}")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_counters_follow_writes(self):
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.u1_id}")
+            c.post(f"/users/follow/{self.u2_id}")
+            c.post(f"/users/stop-following/{self.u2_id}")
+            c.post("/messages/new", data={"text": "counted"})
+            c.post("/users/warble_liking/3456")
+
+            testuser = User.query.get(self.testuser_id)
+            self.assertEqual(testuser.message_count, 3)
+            self.assertEqual(testuser.following_count, 1)
+            self.assertEqual(testuser.follower_count, 0)
+            self.assertEqual(testuser.like_count, 0)
+
+            u1 = User.query.get(self.u1_id)
+            self.assertEqual(u1.follower_count, 1)
+            self.assertEqual(User.query.get(self.u2_id).follower_count, 0)
+
+            c.post("/messages/3456/delete")
+            u1 = User.query.get(self.u1_id)
+            self.assertEqual(u1.message_count, 0)
+
+    def test_delete_user_releases_counters(self):
+        self.setup_likes()
+        self.setup_followers()
+        db.session.add_all([
+            Follows(user_being_followed_id=self.u1_id,
+                    user_following_id=self.u2_id),
+            Likes(user_id=self.u3_id, message_id=3456),
+        ])
+        db.session.commit()
+
+        seen = []
+        changes.subscribe(UserChanged, seen.append)
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                c.post("/users/warble_liking/1234")
+                seen.clear()
+                c.post("/users/delete")
+
+                testuser = User.query.get(self.testuser_id)
+                self.assertEqual(testuser.follower_count, 0)
+                self.assertEqual(testuser.following_count, 1)
+                self.assertEqual(testuser.like_count, 0)
+                self.assertEqual(User.query.get(self.u2_id).following_count,
+                                 0)
+                self.assertEqual(User.query.get(self.u3_id).like_count, 0)
+        finally:
+            changes.unsubscribe(UserChanged, seen.append)
+
+        # everyone whose counts changed, so their cached copies go
+        self.assertCountEqual(seen, [
+            UserChanged(self.u1_id, 'abc', True),
+            UserChanged(self.testuser_id, None, False),
+            UserChanged(self.u2_id, None, False),
+            UserChanged(self.u3_id, None, False),
+        ])
+
+    def test_reconcile_counters(self):
+        self.setup_likes()
+        self.setup_followers()
+
+        User.query.update({User.message_count: 99, User.follower_count: 99})
+        User.reconcile_counters()
+        db.session.commit()
+
+        testuser = User.query.get(self.testuser_id)
+        self.assertEqual(testuser.message_count, 2)
+        self.assertEqual(testuser.following_count, 2)
+        self.assertEqual(testuser.follower_count, 1)
+        self.assertEqual(testuser.like_count, 1)
+
+    def count_selects(self, url):
+        """Number of SELECT statements issued while GETting `url`.
+
+        The page is fetched once beforehand so that the current-user cache
+        is warm and only the per-request queries are counted.
+        """
+
+        self.client.get(url)
+
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            self.client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+        return len(statements)
+
+    def test_user_list_follow_buttons(self):
+        self.setup_followers()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/users")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            unfollow = {form["action"] for form in soup.find_all("form")
+                        if "stop-following" in form.get("action", "")}
+            self.assertEqual(unfollow, {f"/users/stop-following/{self.u1_id}",
+                                        f"/users/stop-following/{self.u2_id}"})
+
+    def test_user_list_queries_stay_flat(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            few = self.count_selects("/users")
+
+            db.session.add_all([
+                Follows(user_being_followed_id=uid,
+                        user_following_id=self.testuser_id)
+                for uid in (self.u1_id, self.u2_id, self.u3_id, self.u4_id)])
+            db.session.commit()
+
+            self.assertEqual(self.count_selects("/users"), few)
+
+    def test_timeline_queries_independent_of_authors(self):
+        start = datetime(2020, 1, 1)
+        authors = [self.u1_id, self.u2_id, self.u3_id, self.u4_id]
+
+        db.session.add_all([
+            Follows(user_being_followed_id=uid,
+                    user_following_id=self.testuser_id)
+            for uid in authors])
+        db.session.add_all([
+            Message(id=200 + i, text=f"own warble {i}",
+                    timestamp=start + timedelta(minutes=i),
+                    user_id=self.testuser_id)
+            for i in range(8)])
+        db.session.commit()
+
+        with app.test_request_context():
+            rebuild_timelines()
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            one_author = self.count_selects("/")
+            one_author_profile = self.count_selects(f"/users/{self.testuser_id}")
+
+            db.session.add_all([
+                Message(id=300 + i, text=f"other warble {i}",
+                        timestamp=start + timedelta(hours=1, minutes=i),
+                        user_id=authors[i % len(authors)])
+                for i in range(8)])
+            db.session.commit()
+
+            with app.test_request_context():
+                rebuild_timelines()
+                db.session.commit()
+
+            self.assertEqual(self.count_selects("/"), one_author)
+            self.assertEqual(self.count_selects(f"/users/{self.testuser_id}"),
+                             one_author_profile)
+
+    def test_two_users_like_same_message(self):
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post("/users/warble_liking/3456")
+            self.assertEqual(resp.status_code, 302)
+
+            likers = {like.user_id for like in
+                      Likes.query.filter(Likes.message_id == 3456)}
+            self.assertEqual(likers, {self.testuser_id, self.u2_id})
+            self.assertEqual(User.query.get(self.u2_id).like_count, 1)
+
+    def test_homepage_like_buttons(self):
+        self.setup_likes()
+
+        db.session.add(Follows(user_being_followed_id=self.u1_id,
+                               user_following_id=self.testuser_id))
+        db.session.commit()
+
+        with app.test_request_context():
+            rebuild_timelines()
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+
+            liked = {form["action"] for form in soup.find_all("form")
+                     if form.find("button", class_="btn-primary")}
+            self.assertEqual(liked, {"/users/warble_liking/3456"})
+
+    def test_follow_is_idempotent(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.u1_id}")
+            resp = c.post(f"/users/follow/{self.u1_id}")
+            self.assertEqual(resp.status_code, 302)
+
+            follows = Follows.query.filter_by(user_following_id=self.testuser_id)
+            self.assertEqual(follows.count(), 1)
+            self.assertEqual(User.query.get(self.testuser_id).following_count, 1)
+            self.assertEqual(User.query.get(self.u1_id).follower_count, 1)
+
+            c.post(f"/users/stop-following/{self.u1_id}")
+            resp = c.post(f"/users/stop-following/{self.u1_id}")
+            self.assertEqual(resp.status_code, 302)
+
+            follows = Follows.query.filter_by(user_following_id=self.testuser_id)
+            self.assertEqual(follows.count(), 0)
+            self.assertEqual(User.query.get(self.testuser_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u1_id).follower_count, 0)
+
+    def test_stop_following_unknown_user(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/users/stop-following/999999")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_bulk_follow(self):
+        self.setup_followers()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/users/follow", data={"user_id": [
+                self.u1_id, self.u3_id, self.u4_id, self.testuser_id, 999999]})
+            self.assertEqual(resp.status_code, 302)
+
+            followed = {f.user_being_followed_id for f in
+                        Follows.query.filter_by(user_following_id=self.testuser_id)}
+            self.assertEqual(followed, {self.u1_id, self.u2_id,
+                                        self.u3_id, self.u4_id})
+            self.assertEqual(User.query.get(self.testuser_id).following_count, 4)
+            self.assertEqual(User.query.get(self.u3_id).follower_count, 1)
+
+    def test_current_user_cached_between_requests(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            statements = []
+
+            def capture(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            c.get("/")
+
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            try:
+                resp = c.get("/")
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', capture)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse([s for s in statements
+                              if "FROM users \nWHERE users.id = " in s])
+
+    def test_current_user_refreshed_after_change(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/")
+            c.post(f"/users/follow/{self.u1_id}")
+
+            resp = c.get("/")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            following = soup.find("a", href=f"/users/{self.testuser_id}/following")
+            self.assertEqual(following.text, "1")
+
+    def test_deleted_user_not_cached(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/")
+            c.post("/users/delete")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/users/profile", follow_redirects=True)
+            self.assertIn("Access unauthorized", str(resp.data))
+
+    def test_metrics(self):
+        self.client.post("/login", data={"username": "testuser",
+                                         "password": "password"})
+
+        before = in_flight()
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        text = resp.get_data(as_text=True)
+
+        self.assertIn('warbler_requests_total{endpoint="warbler.login",'
+                      'method="POST",status="302"}', text)
+        self.assertIn('warbler_request_duration_seconds_bucket'
+                      '{endpoint="warbler.login",le="+Inf"}', text)
+        self.assertIn('warbler_password_hash_seconds_count'
+                      '{operation="check"}', text)
+        self.assertIn('warbler_db_pool_checkout_seconds_count', text)
+        # the /metrics request itself
+        self.assertIn(f'warbler_requests_in_flight {before + 1}', text)
+
+    def test_metrics_across_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['METRICS_DIR'] = directory
+
+            # a worker that has since exited, and one whose pid we were
+            # given after it exited
+            for filename in ["999999999-1.json", f"{os.getpid()}-1.json"]:
+                with open(os.path.join(directory, filename), 'w') as out:
+                    json.dump([
+                        ['warbler_requests_total',
+                         [['endpoint', 'warbler.homepage'], ['method', 'GET'],
+                          ['status', 200]], 1000],
+                        ['warbler_requests_in_flight', [], 7],
+                    ], out)
+
+            try:
+                self.client.get("/")
+                before = in_flight()
+                text = self.client.get("/metrics").get_data(as_text=True)
+            finally:
+                app.config['METRICS_DIR'] = None
+
+        lines = text.splitlines()
+        homepage = [line for line in lines if line.startswith(
+            'warbler_requests_total{endpoint="warbler.homepage",method="GET",'
+            'status="200"}')]
+        self.assertGreater(int(homepage[0].split()[-1]), 2000)
+        self.assertIn(f'warbler_requests_in_flight {before + 1}', lines)
+
+    def test_production_profile(self):
+        prod = create_app('production')
+
+        self.assertFalse(prod.debug)
+        self.assertNotIn('debugtoolbar', prod.blueprints)
+        self.assertIsNotNone(prod.jinja_env.bytecode_cache)
+        self.assertIn('base.html', [key[1] for key in prod.jinja_env.cache.keys()])
+
+        text = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn('warbler_startup_seconds', text)
+
+    def test_template_cache_dir_must_be_private(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ['TEMPLATE_CACHE_DIR'] = directory
+
+            try:
+                os.chmod(directory, 0o777)
+                with self.assertRaises(ValueError):
+                    create_app('production')
+
+                os.chmod(directory, 0o700)
+                prod = create_app('production')
+                self.assertEqual(prod.jinja_env.bytecode_cache.directory,
+                                 directory)
+            finally:
+                del os.environ['TEMPLATE_CACHE_DIR']
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            create_app('staging')
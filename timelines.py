@@ -0,0 +1,410 @@
+"""Materialized home timelines for Warbler.
+
+Every user's home timeline is stored as rows in the `timelines` table, one
+row per (reader, message). Rows are pushed when a message is posted, removed
+when it is deleted, and backfilled/pruned when the follow graph changes, so
+reading a timeline is a single bounded range read of the primary key
+(user_id, message_id): message ids are time-ordered (see snowflake.py).
+
+Accounts with more than TIMELINE_FANOUT_THRESHOLD followers are not pushed
+(one post would mean tens of thousands of inserts); instead their recent
+messages are pulled and merged in when a timeline is read.
+"""
+
+import time
+
+from flask import current_app
+from sqlalchemy import (and_, exists, func, literal, select, tuple_,
+                        union_all)
+
+from changes import changes, record, FanoutChanged
+from models import db, Follows, Message, TimelineEntry, User
+
+DEFAULT_TIMELINE_LENGTH = 800
+DEFAULT_TRIM_EVERY = 50
+DEFAULT_FANOUT_THRESHOLD = 10000
+DEFAULT_HIGH_FOLLOWER_TTL = 60
+
+TIMELINE_COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+
+def timeline_length():
+    """How many entries we keep per user timeline."""
+
+    return current_app.config.get('TIMELINE_LENGTH', DEFAULT_TIMELINE_LENGTH)
+
+
+def trim_every():
+    """About how many pushes a timeline takes between trims."""
+
+    return current_app.config.get('TIMELINE_TRIM_EVERY', DEFAULT_TRIM_EVERY)
+
+
+def fanout_threshold():
+    """Follower count above which an account is pulled rather than pushed."""
+
+    return current_app.config.get('TIMELINE_FANOUT_THRESHOLD',
+                                  DEFAULT_FANOUT_THRESHOLD)
+
+
+_high_follower_cache = {'ids': frozenset(), 'threshold': None, 'expires': 0}
+
+
+def high_follower_ids():
+    """Ids of accounts whose messages are pulled at read time.
+
+    The set is small and changes slowly, so it is cached in-process and
+    refreshed every TIMELINE_HIGH_FOLLOWER_TTL seconds. Writers decide from
+    their copy whether to push a message, readers from theirs whether to
+    pull it. The writes that take an account across the threshold send a
+    FanoutChanged, on which every worker drops its copy; one that drops
+    to the threshold (by unfollows or deleted followers) also has its
+    recent messages pushed to its followers then, as they stop pulling
+    them (see check_fanout_drops()). Between the commit and a worker
+    hearing of it, a message can still be neither pushed nor pulled;
+    rebuild_timelines() puts those back.
+    """
+
+    threshold = fanout_threshold()
+    now = time.monotonic()
+
+    if (_high_follower_cache['expires'] <= now
+            or _high_follower_cache['threshold'] != threshold):
+        ids = db.session.query(User.id).filter(User.follower_count > threshold)
+
+        _high_follower_cache['ids'] = frozenset(row[0] for row in ids)
+        _high_follower_cache['threshold'] = threshold
+        _high_follower_cache['expires'] = now + current_app.config.get(
+            'TIMELINE_HIGH_FOLLOWER_TTL', DEFAULT_HIGH_FOLLOWER_TTL)
+
+    return _high_follower_cache['ids']
+
+
+def clear_high_follower_cache():
+    """Forget the cached high-follower set (next read recomputes it)."""
+
+    _high_follower_cache['expires'] = 0
+
+
+def forget_high_followers(change):
+    clear_high_follower_cache()
+
+
+changes.subscribe(FanoutChanged, forget_high_followers)
+
+
+def fan_out_message(msg):
+    """Push `msg` onto its author's timeline and their followers' timelines.
+
+    The message must already be flushed (so it has an id and timestamp).
+    High-follower authors only get the row on their own timeline; their
+    followers pull the message when reading.
+
+    Trimming every timeline that got the row would rank all their entries
+    on every post (up to threshold x length rows); instead about one in
+    TIMELINE_TRIM_EVERY of them, picked at random, is trimmed back to the
+    configured length, so a timeline runs that many entries over on
+    average.
+    """
+
+    author = select([
+        literal(msg.user_id).label('user_id'),
+        literal(msg.id).label('message_id'),
+        literal(msg.user_id).label('author_id'),
+        literal(msg.timestamp, db.DateTime).label('timestamp'),
+    ])
+
+    followers = (select([
+        Follows.user_following_id.label('user_id'),
+        literal(msg.id).label('message_id'),
+        literal(msg.user_id).label('author_id'),
+        literal(msg.timestamp, db.DateTime).label('timestamp'),
+    ]).where(Follows.user_being_followed_id == msg.user_id))
+
+    if msg.user_id in high_follower_ids():
+        rows = author
+    else:
+        rows = union_all(author, followers)
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(TIMELINE_COLUMNS, rows))
+
+    readers = rows.alias('readers')
+    sample = select([readers.c.user_id])
+    if trim_every() > 1:
+        sample = sample.where(func.random() * trim_every() < 1)
+
+    trim_timelines(sample)
+
+
+def remove_message(msg):
+    """Drop `msg` from every timeline it was pushed to."""
+
+    (TimelineEntry
+        .query
+        .filter(TimelineEntry.message_id == msg.id)
+        .delete(synchronize_session=False))
+
+
+def backfill_follow(follower_id, followed_id):
+    """Copy recent messages of `followed_id` into `follower_id`'s timeline.
+
+    Nothing is copied for high-follower accounts; they are pulled on read.
+    Call after the follow: if it took `followed_id` over the fan-out
+    threshold, every worker is told to start pulling them.
+    """
+
+    follower_count = (db.session
+                      .query(User.follower_count)
+                      .filter(User.id == followed_id)
+                      .scalar())
+
+    if follower_count == fanout_threshold() + 1:
+        record(db.session, FanoutChanged(followed_id, True))
+        clear_high_follower_cache()
+
+    if followed_id in high_follower_ids():
+        return
+
+    recent = (select([
+        literal(follower_id).label('user_id'),
+        Message.id.label('message_id'),
+        Message.user_id.label('author_id'),
+        Message.timestamp,
+    ])
+        .where(Message.user_id == followed_id)
+        .order_by(Message.id.desc())
+        .limit(timeline_length()))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(TIMELINE_COLUMNS, recent))
+
+    trim_timeline(follower_id)
+
+
+def prune_follow(follower_id, followed_id):
+    """Remove messages of `followed_id` from `follower_id`'s timeline.
+
+    Call after the unfollow: it may have taken `followed_id` down to the
+    fan-out threshold (see check_fanout_drops()).
+    """
+
+    (TimelineEntry
+        .query
+        .filter(TimelineEntry.user_id == follower_id,
+                TimelineEntry.author_id == followed_id)
+        .delete(synchronize_session=False))
+
+    check_fanout_drops([followed_id])
+
+
+def check_fanout_drops(user_ids):
+    """Go back to pushing for any of `user_ids` that just lost followers
+    down to the fan-out threshold.
+
+    Their followers stop pulling their messages, so the recent ones are
+    pushed to them now, and every worker is told to drop its cached
+    high-follower set.
+    """
+
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+
+    dropped = [row[0] for row in (db.session
+                                  .query(User.id)
+                                  .filter(User.id.in_(user_ids),
+                                          User.follower_count
+                                          == fanout_threshold()))]
+
+    for user_id in dropped:
+        backfill_followers(user_id)
+
+    if dropped:
+        record(db.session, *(FanoutChanged(user_id, False)
+                             for user_id in dropped))
+        clear_high_follower_cache()
+
+
+def backfill_followers(author_id):
+    """Copy recent messages of `author_id` into all their followers'
+    timelines, skipping entries already there."""
+
+    recent = (select([Message.id, Message.user_id, Message.timestamp])
+              .where(Message.user_id == author_id)
+              .order_by(Message.id.desc())
+              .limit(timeline_length())
+              .alias('recent'))
+
+    followers = (select([Follows.user_following_id])
+                 .where(Follows.user_being_followed_id == author_id))
+
+    rows = (select([
+        Follows.user_following_id.label('user_id'),
+        recent.c.id.label('message_id'),
+        recent.c.user_id.label('author_id'),
+        recent.c.timestamp,
+    ])
+        .where(Follows.user_being_followed_id == author_id)
+        .where(~exists().where(and_(
+            TimelineEntry.user_id == Follows.user_following_id,
+            TimelineEntry.message_id == recent.c.id))))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(TIMELINE_COLUMNS, rows))
+
+    trim_timelines(followers)
+
+
+def trim_timelines(readers):
+    """Drop entries beyond the configured timeline length for every user
+    id selected by `readers`, in one statement."""
+
+    ranked = select([
+        TimelineEntry.user_id,
+        TimelineEntry.message_id,
+        func.row_number().over(
+            partition_by=TimelineEntry.user_id,
+            order_by=TimelineEntry.message_id.desc(),
+        ).label('position'),
+    ]).where(TimelineEntry.user_id.in_(readers)).alias('ranked')
+
+    excess = (select([ranked.c.user_id, ranked.c.message_id])
+              .where(ranked.c.position > timeline_length()))
+
+    db.session.execute(
+        TimelineEntry.__table__.delete()
+        .where(tuple_(TimelineEntry.user_id, TimelineEntry.message_id)
+               .in_(excess)))
+
+
+def trim_timeline(user_id):
+    """Drop entries beyond the configured timeline length for `user_id`."""
+
+    keep = (db.session
+            .query(TimelineEntry.message_id)
+            .filter(TimelineEntry.user_id == user_id)
+            .order_by(TimelineEntry.message_id.desc())
+            .limit(timeline_length())
+            .subquery())
+
+    (TimelineEntry
+        .query
+        .filter(TimelineEntry.user_id == user_id,
+                ~TimelineEntry.message_id.in_(select([keep.c.message_id])))
+        .delete(synchronize_session=False))
+
+
+def timeline_messages(user_id, limit=100, before=None, after=None):
+    """Messages on `user_id`'s home timeline, newest first.
+
+    `before`/`after` are (id,) keys to page from; with `after`
+    the messages closest to the key come first (oldest first), which is
+    what `pagination.keyset_page` expects.
+
+    Reads the pushed entries and merges in recent messages of any
+    high-follower accounts `user_id` follows. Authors are loaded in the
+    same query, so rendering the page needs no per-message lookups.
+    """
+
+    pushed = _keyset(Message
+                     .query
+                     .options(db.joinedload(Message.user))
+                     .join(TimelineEntry,
+                           TimelineEntry.message_id == Message.id)
+                     .filter(TimelineEntry.user_id == user_id),
+                     TimelineEntry.message_id,
+                     before, after).limit(limit).all()
+
+    pulled_ids = followed_high_follower_ids(user_id)
+
+    if not pulled_ids:
+        return pushed
+
+    pulled = _keyset(Message
+                     .query
+                     .options(db.joinedload(Message.user))
+                     .filter(Message.user_id.in_(pulled_ids)),
+                     Message.id,
+                     before, after).limit(limit).all()
+
+    merged = {msg.id: msg for msg in pushed + pulled}
+    return sorted(merged.values(), key=lambda msg: msg.id,
+                  reverse=after is None)[:limit]
+
+
+def _keyset(query, id_col, before, after):
+    """Restrict and order `query` to rows beyond the `before`/`after` key.
+
+    Only the key's last element, the message id, is used, so cursors made
+    before ids were time-ordered, (timestamp, id), still work.
+    """
+
+    if after:
+        return query.filter(id_col > after[-1]).order_by(id_col.asc())
+
+    if before:
+        query = query.filter(id_col < before[-1])
+
+    return query.order_by(id_col.desc())
+
+
+def followed_high_follower_ids(user_id):
+    """Ids of high-follower accounts that `user_id` follows."""
+
+    candidates = high_follower_ids() - {user_id}
+
+    if not candidates:
+        return []
+
+    return [row[0] for row in (db.session
+                               .query(Follows.user_being_followed_id)
+                               .filter(Follows.user_following_id == user_id,
+                                       Follows.user_being_followed_id
+                                       .in_(candidates)))]
+
+
+def rebuild_timelines():
+    """Recompute every timeline from `messages` and `follows`.
+
+    Used after bulk loads (see seed.py), which bypass the write paths, and
+    by migration 1. High-follower accounts are counted from `follows`
+    rather than read from the user counters, so this also works on a
+    schema that does not have them yet.
+    """
+
+    authored = select([
+        Message.user_id.label('user_id'),
+        Message.id.label('message_id'),
+        Message.user_id.label('author_id'),
+        Message.timestamp,
+    ])
+
+    followed = (select([
+        Follows.user_following_id.label('user_id'),
+        Message.id.label('message_id'),
+        Message.user_id.label('author_id'),
+        Message.timestamp,
+    ]).where(Follows.user_being_followed_id == Message.user_id))
+
+    pulled_ids = (select([Follows.user_being_followed_id])
+                  .group_by(Follows.user_being_followed_id)
+                  .having(func.count() > fanout_threshold()))
+    followed = followed.where(~Message.user_id.in_(pulled_ids))
+
+    combined = union_all(authored, followed).alias('combined')
+
+    ranked = select([
+        combined,
+        func.row_number().over(
+            partition_by=combined.c.user_id,
+            order_by=combined.c.message_id.desc(),
+        ).label('position'),
+    ]).alias('ranked')
+
+    db.session.execute(TimelineEntry.__table__.delete())
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            TIMELINE_COLUMNS,
+            select([ranked.c[name] for name in TIMELINE_COLUMNS])
+            .where(ranked.c.position <= timeline_length())))
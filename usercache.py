@@ -0,0 +1,99 @@
+"""Cache of logged-in users for the before_request hook.
+
+Loading the current user on every request is one guaranteed query, even on
+pages that only need the avatar and username for the nav bar. Instead we
+keep read-only snapshots of recently seen users in a small in-process LRU
+with a short TTL. Routes that change the user load the full ORM object with
+app.current_user(); any committed change to a user, their counters
+included, drops their snapshot (see changes.py).
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from changes import changes, UserChanged
+from models import User
+
+SNAPSHOT_FIELDS = [
+    'id', 'username', 'email', 'image_url', 'header_image_url', 'bio',
+    'location', 'message_count', 'following_count', 'follower_count',
+    'like_count',
+]
+
+
+class UserSnapshot(namedtuple('UserSnapshot', SNAPSHOT_FIELDS)):
+    """Read-only copy of a user's columns, safe to keep between requests."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(*(getattr(user, field) for field in SNAPSHOT_FIELDS))
+
+    # These User queries only need the user's id, so a snapshot can run
+    # them without loading the ORM object.
+    following_ids = User.following_ids
+    follow_states = User.follow_states
+    is_following = User.is_following
+    is_followed_by = User.is_followed_by
+    liked_message_ids = User.liked_message_ids
+
+
+class SnapshotCache:
+    """Bounded LRU of UserSnapshots whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Snapshot of `user_id`, from the cache or the database.
+
+        Returns None if there is no such user (that is not cached).
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        user = User.query.get(user_id)
+        if user is None:
+            self.forget(user_id)
+            return None
+
+        snapshot = UserSnapshot.from_user(user)
+
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, snapshot)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return snapshot
+
+    def forget(self, user_id):
+        """Drop `user_id` so the next request reloads it."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_snapshots = SnapshotCache()
+
+
+def forget_changed_user(change):
+    user_snapshots.forget(change.user_id)
+
+
+changes.subscribe(UserChanged, forget_changed_user)